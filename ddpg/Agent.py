@@ -6,6 +6,8 @@ import torch.nn.functional as F
 from torch import nn, Tensor
 from torch.optim import Adam
 
+from Compiled import inference
+
 
 class Agent:
     """Agent that can interact with environment from pettingzoo"""
@@ -42,6 +44,7 @@ class Agent:
             return action, logits
         return action
 
+    @inference
     def target_action(self, obs):
         # when calculate target critic value in MADDPG,
         # we use target actor to get next action given next states,
@@ -50,13 +53,14 @@ class Agent:
         logits = self.target_actor(obs)  # torch.Size([batch_size, action_size])
         # action = self.gumbel_softmax(logits)
         action = F.gumbel_softmax(logits, hard=True)
-        return action.squeeze(0).detach()
+        return action.squeeze(0)
 
     def critic_value(self, state: Tensor, act: Tensor):
 
         x = torch.cat((state , act), 1)
         return self.critic(x).squeeze(1)  # tensor with a given length
     
+    @inference
     def target_critic_value(self, state: Tensor, act: Tensor):
         x = torch.cat((state , act), 1)
         return self.target_critic(x).squeeze(1)  # tensor with a given length
@@ -0,0 +1,110 @@
+import torch
+import torch.nn.functional as F
+from torch import nn
+from torch.optim import Adam
+
+from Compiled import inference
+
+
+def _pack(networks, requires_grad=False):
+    """pack the parameters of `networks` (sequential modules of the same shape) into stacked tensors,
+    e.g. the weights of a linear layer of 3 networks are a tensor of size (3, out_dim, in_dim).
+    the parameters of each network become views of their slice, so they can still be trained, saved and loaded
+    as before, and the stack always holds their current value without copying them.
+    return the layers: (weight, bias) for a linear layer, or the module itself if it is element-wise"""
+    layers = []
+    for modules in zip(*networks):
+        if isinstance(modules[0], nn.Linear):
+            weight = torch.stack([m.weight.data for m in modules])
+            bias = torch.stack([m.bias.data for m in modules]).unsqueeze(1)
+            if requires_grad:
+                weight, bias = nn.Parameter(weight), nn.Parameter(bias)
+            for g, m in enumerate(modules):
+                m.weight.data = weight.data[g]
+                m.bias.data = bias.data[g, 0]
+            layers.append((weight, bias))
+        else:  # element-wise, e.g. activation
+            layers.append(modules[0])
+    return layers
+
+
+def _forward(layers, x):
+    """evaluate the packed networks on `x` of size (network_num, batch_size, in_dim) with batched matmul"""
+    for layer in layers:
+        if isinstance(layer, tuple):
+            weight, bias = layer
+            x = torch.baddbmm(bias, x, weight.transpose(1, 2))
+        else:
+            x = layer(x)
+    return x
+
+
+class ActorEnsemble:
+    """evaluate the actors of all the agents in one pass, with a batched matmul for the actors of the same shape
+
+    the parameters of the actors of the same shape are packed into stacked tensors, see `_pack`.
+    `obs_slices` is the block of each actor in the joint obs, as `Buffer.obs_slices`.
+    """
+
+    def __init__(self, actors, obs_slices):
+        self.agent_num = len(actors)
+        # actors with the same layers are grouped together
+        groups = {}
+        for i, actor in enumerate(actors):
+            key = tuple((type(m), tuple(p.shape for p in m.parameters())) for m in actor.net)
+            groups.setdefault(key, []).append(i)
+
+        self.groups = []  # (index of the actors, their obs slices, layers)
+        for index in groups.values():
+            layers = _pack([actors[i].net for i in index])
+            self.groups.append((index, [obs_slices[i] for i in index], layers))
+
+    def _forward(self, obs):
+        """logits of each group of actors given the joint obs (of size (batch_size, sum of obs_dim)),
+        of size (group_size, batch_size, act_dim)"""
+        for index, obs_slices, layers in self.groups:
+            x = torch.stack([obs[:, s] for s in obs_slices])  # torch.Size([group_size, batch_size, obs_dim])
+            yield index, _forward(layers, x)
+
+    @inference
+    def action(self, obs):
+        """sample the action of all the agents as `Agent.action`, as int of size (batch_size, agent_num)"""
+        action = torch.empty(obs.shape[0], self.agent_num, dtype=torch.long)
+        for index, logits in self._forward(obs):
+            action[:, index] = F.gumbel_softmax(logits, hard=True).argmax(dim=-1).T
+        return action
+
+
+class CriticEnsemble:
+    """the critics of all the agents (of the same shape), evaluated and trained together
+
+    the parameters of the critics and of the target critics are packed into stacked tensors, see `_pack`.
+    a single Adam optimizer updates the stacked parameters, which is element-wise the same as an optimizer
+    for each critic, and the gradient is clipped by the norm of each critic, as `clip_grad_norm_` on it.
+    """
+
+    def __init__(self, critics, target_critics, lr, max_norm=0.5):
+        self.layers = _pack([critic.net for critic in critics], requires_grad=True)
+        self.target_layers = _pack([critic.net for critic in target_critics])
+        self.params = [p for layer in self.layers if isinstance(layer, tuple) for p in layer]
+        self.optimizer = Adam(self.params, lr=lr)
+        self.max_norm = max_norm
+
+    def value(self, x):
+        """value of each critic given its input, `x` is of size (critic_num, batch_size, in_dim)"""
+        return _forward(self.layers, x).squeeze(-1)
+
+    @inference
+    def target_value(self, x):
+        return _forward(self.target_layers, x).squeeze(-1)
+
+    def update(self, loss):
+        """`loss` is the sum of the loss of each critic"""
+        self.optimizer.zero_grad()
+        loss.backward()
+        # the gradient norm of each critic, of size (critic_num)
+        norm = torch.stack([p.grad.flatten(1).norm(dim=1) for p in self.params]).norm(dim=0)
+        clip_coef = (self.max_norm / (norm + 1e-6)).clamp(max=1.0)
+        for p in self.params:
+            p.grad.mul_(clip_coef.view(-1, *[1] * (p.dim() - 1)))
+        self.optimizer.step()
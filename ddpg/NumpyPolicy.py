@@ -0,0 +1,163 @@
+import argparse
+import json
+import os
+
+import numpy as np
+
+
+def quantize(weight):
+    """quantize `weight` of size (in_dim, out_dim) to int8 symmetrically with a scale of each output channel,
+    so that `weight` is about `int8_weight * scale`, return the int8 weight and the scales"""
+    scale = np.abs(weight).max(axis=0) / 127
+    scale[scale == 0] = 1
+    return np.round(weight / scale).astype(np.int8), scale.astype(np.float32)
+
+
+def export(model_file, file, int8=False):
+    """freeze the actors saved in `model_file` (see `MADDPG.save`) into numpy arrays saved in `file` (.npz),
+    the weight of each linear layer is transposed to (in_dim, out_dim), so that a layer is `x @ weight + bias`,
+    if `int8`, the weights are quantized with `quantize`, the biases are kept in float"""
+    import torch  # only exporting needs torch
+
+    data = torch.load(model_file)
+    arrays = {'agents': np.array(list(data))}
+    for agent_id, state_dict in data.items():
+        weights = [v for name, v in state_dict.items() if name.endswith('weight')]
+        biases = [v for name, v in state_dict.items() if name.endswith('bias')]
+        for k, (weight, bias) in enumerate(zip(weights, biases)):
+            weight = np.ascontiguousarray(weight.numpy().T)
+            if int8:
+                arrays[f'{agent_id}.weight{k}'], arrays[f'{agent_id}.scale{k}'] = quantize(weight)
+            else:
+                arrays[f'{agent_id}.weight{k}'] = weight
+            arrays[f'{agent_id}.bias{k}'] = bias.numpy()
+    np.savez(file, **arrays)
+
+
+def drift(policy, reference, obs):
+    """fraction of the actions (of the largest logit) of `policy` that differ from those of `reference`
+    given the joint obs of size (n, sum of obs_dim), of each agent"""
+    return np.mean(policy.action(obs) != reference.action(obs), axis=0)
+
+
+def replayed_obs(buffer_dir, num, seed=None):
+    """`num` joint obs sampled from the replay buffer kept in `buffer_dir` (see `MemmapBuffer`), of size
+    (num, sum of obs_dim), they are held out from the quantization, which only looks at the weights"""
+    from Buffer import MemmapBuffer  # only reading the buffer needs torch
+
+    with open(os.path.join(buffer_dir, MemmapBuffer.header_file)) as f:
+        header = json.load(f)
+    dim_info = dict(zip(header['agents'], header['dims']))
+    buffer = MemmapBuffer(header['capacity'], dim_info, 'cpu', buffer_dir, header['dedup_obs'], header['obs_dtype'],
+                          readonly=True)
+    indices = np.random.default_rng(seed).choice(len(buffer), min(num, len(buffer)), replace=False)
+    return buffer.sample(indices)[0].numpy()
+
+
+class NumpyPolicy:
+    """the actors of all the agents exported by `export`, evaluated in numpy without importing torch
+
+    an actor (`MLPNetwork`) is a chain of linear layers with ReLU in between,
+    the actors of the same shape are evaluated together with a batched matmul as `ActorEnsemble`.
+    `layers` maps each agent (in the order of the joint obs) to the list of (weight, bias, scale) of its linear
+    layers, scale is None for a float weight, or the scale of each output channel of an int8 weight (see `quantize`),
+    which is kept in int8 and scaled on the fly, as `x @ (weight * scale)` is `(x @ weight) * scale`.
+    """
+
+    def __init__(self, layers, seed=None):
+        self.agents = list(layers)
+        obs_dims = [agent_layers[0][0].shape[0] for agent_layers in layers.values()]
+        bounds = np.cumsum([0] + obs_dims)
+        obs_slices = [slice(start, stop) for start, stop in zip(bounds[:-1], bounds[1:])]
+
+        # actors with the same layers are grouped together
+        groups = {}
+        for i, agent_layers in enumerate(layers.values()):
+            key = tuple((weight.shape, weight.dtype) for weight, _, _ in agent_layers)
+            groups.setdefault(key, []).append(i)
+
+        self.groups = []  # (index of the actors, their obs slices, stacked (weight, bias, scale) of each layer)
+        all_layers = list(layers.values())
+        for index in groups.values():
+            stacked = []
+            for k, (_, _, scale) in enumerate(all_layers[index[0]]):
+                weight, bias = [np.stack([all_layers[i][k][j] for i in index]) for j in (0, 1)]
+                if scale is not None:
+                    scale = np.stack([all_layers[i][k][2] for i in index])[:, None]
+                stacked.append((weight, bias[:, None], scale))
+            self.groups.append((index, [obs_slices[i] for i in index], stacked))
+        self.np_random = np.random.default_rng(seed)
+
+    @classmethod
+    def load(cls, file, seed=None):
+        """init the policy using the actors exported to `file`"""
+        data = np.load(file)
+        layers = {}
+        for agent_id in data['agents']:
+            agent_id, k = str(agent_id), 0
+            layers[agent_id] = []
+            while f'{agent_id}.weight{k}' in data:
+                scale = data[f'{agent_id}.scale{k}'] if f'{agent_id}.scale{k}' in data else None
+                layers[agent_id].append((data[f'{agent_id}.weight{k}'], data[f'{agent_id}.bias{k}'], scale))
+                k += 1
+        return cls(layers, seed)
+
+    def _forward(self, obs):
+        """logits of each group of actors given the joint obs (of size (batch_size, sum of obs_dim)),
+        of size (group_size, batch_size, act_dim)"""
+        for index, obs_slices, layers in self.groups:
+            x = np.stack([obs[:, s] for s in obs_slices])
+            for k, (weight, bias, scale) in enumerate(layers):
+                x = np.matmul(x, weight)
+                if scale is not None:
+                    x *= scale
+                x += bias
+                if k < len(layers) - 1:
+                    np.maximum(x, 0, out=x)  # ReLU
+            yield index, x
+
+    @property
+    def nbytes(self):
+        """memory taken by the parameters of the actors"""
+        return sum(a.nbytes for _, _, layers in self.groups for layer in layers for a in layer if a is not None)
+
+    def action(self, obs, explore=False):
+        """the action of all the agents given the joint obs of a single env or stacked over env copies,
+        an int of each agent, of size (agent_num) or (num_envs, agent_num) accordingly.
+        the action of largest logit, or sampled as `Agent.action` (gumbel-max) if `explore`"""
+        o = np.atleast_2d(np.asarray(obs, dtype=np.float32))
+        action = np.empty((o.shape[0], len(self.agents)), dtype=np.int64)
+        for index, logits in self._forward(o):
+            if explore:
+                logits += self.np_random.gumbel(size=logits.shape)
+            action[:, index] = logits.argmax(axis=-1).T
+        return action if np.ndim(obs) > 1 else action[0]
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('env_name', type=str, help='name of the env')
+    parser.add_argument('folder', type=str, help='name of the folder where model is saved')
+    parser.add_argument('--int8', action='store_true',
+                        help='also export the actors with int8 weights to model_int8.npz, and report the drift '
+                             'of their actions from the float actors')
+    parser.add_argument('--buffer', type=str, default=None,
+                        help='folder of the replay buffer (kept by main.py --memmap) whose observations the drift is '
+                             'measured on, by default the buffer of the model folder')
+    parser.add_argument('--drift_num', type=int, default=10000, help='observations the drift is measured on')
+    args = parser.parse_args()
+
+    model_dir = os.path.join('./results', args.env_name, args.folder)
+    buffer_dir = args.buffer or os.path.join(model_dir, 'buffer')
+    if args.int8 and not os.path.exists(os.path.join(buffer_dir, 'header.json')):
+        parser.error(f'no replay buffer in {buffer_dir} to measure the drift on, train with --memmap or set --buffer')
+    export(os.path.join(model_dir, 'model.pt'), os.path.join(model_dir, 'model.npz'))
+    if args.int8:
+        export(os.path.join(model_dir, 'model.pt'), os.path.join(model_dir, 'model_int8.npz'), int8=True)
+        policy = NumpyPolicy.load(os.path.join(model_dir, 'model.npz'))
+        int8_policy = NumpyPolicy.load(os.path.join(model_dir, 'model_int8.npz'))
+        obs = replayed_obs(buffer_dir, args.drift_num)
+        agent_drift = drift(int8_policy, policy, obs)
+        print(f'int8 actors: {int8_policy.nbytes / 1024:.1f}KB in memory ({policy.nbytes / 1024:.1f}KB in float), '
+              f'actions that differ on {len(obs)} replayed observations: '
+              + '; '.join(f'{agent_id}: {d:.2%}' for agent_id, d in zip(policy.agents, agent_drift)))
@@ -0,0 +1,65 @@
+import queue
+import threading
+import time
+
+import torch
+
+
+class Prefetcher:
+    """gather batches from the replay buffer in a background thread, while the learner runs the gradient steps
+
+    the batches are gathered into a ring of `depth` preallocated batch slots (see `Buffer.alloc_batch`),
+    a slot handed out by `get` is in use until the next call of `get`, so `depth` should be at least 2.
+    `lock` guards the buffer and the sampler, it should also be held when adding experience or updating priorities.
+    """
+
+    def __init__(self, buffer, sampler, batch_size, lock, depth=2):
+        self.buffer = buffer
+        self.sampler = sampler
+        self.batch_size = batch_size
+        self.lock = lock
+
+        pin_memory = torch.device(buffer.device).type == 'cuda'
+        self.slots = [buffer.alloc_batch(batch_size, pin_memory) for _ in range(depth)]
+        self._free = queue.Queue()  # slots to be filled
+        self._ready = queue.Queue()  # filled slots, with the indices and weights of the batch
+        for slot in range(depth):
+            self._free.put(slot)
+        self._in_use = None  # the slot handed out by the last `get`
+
+        self.wait_time = 0  # total time the learner waits in `get`
+
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        while True:
+            slot = self._free.get()
+            if slot is None:  # closed
+                return
+            try:
+                with self.lock:
+                    total_num = len(self.buffer)
+                    indices = self.sampler.sample(total_num, self.batch_size)
+                    weights = self.sampler.weights(total_num, indices)
+                    batch = self.buffer.sample(indices, self.slots[slot])
+            except Exception as e:  # hand the error over to the learner instead of leaving it waiting forever
+                self._ready.put(e)
+                return
+            self._ready.put((slot, batch, indices, weights))
+
+    def get(self):
+        """the next batch: (obs, action, reward, next_obs, done), indices, weights"""
+        if self._in_use is not None:  # the learner is done with the previous batch
+            self._free.put(self._in_use)
+        start = time.perf_counter()
+        item = self._ready.get()
+        self.wait_time += time.perf_counter() - start
+        if isinstance(item, Exception):
+            raise item
+        self._in_use, batch, indices, weights = item
+        return batch, indices, weights
+
+    def close(self):
+        self._free.put(None)
+        self._thread.join()
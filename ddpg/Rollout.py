@@ -0,0 +1,107 @@
+import multiprocessing as mp
+import queue
+from copy import deepcopy
+
+import numpy as np
+import torch
+
+from Ensemble import ActorEnsemble
+
+
+def _rollout(env_fn, shared_actors, obs_slices, version, weights_lock, transitions, stop, random_steps):
+    """interact with the env copies created by `env_fn` (e.g. a `VectorEnv`) using the latest published actors,
+    put the experience of each step to `transitions`, with the reward of the episodes finished in this step,
+    or the error raised, which ends the process
+    `shared_actors` is the list of actors in the agent order, the obs of each is `obs_slices` of the joint obs"""
+    torch.set_num_threads(1)  # the cores are for the other rollout processes and the learner
+    try:
+        env = env_fn()
+        num_envs = env.num_envs
+        actors = deepcopy(shared_actors)
+        actor_ensemble = ActorEnsemble(actors, obs_slices)
+        local_version = -1
+
+        step = 0
+        agent_reward = np.zeros((num_envs, len(actors)))
+        obs = env.reset()
+        while not stop.is_set():
+            if version.value != local_version:  # new actors are published
+                with weights_lock:
+                    for actor, shared_actor in zip(actors, shared_actors):
+                        actor.load_state_dict(shared_actor.state_dict())
+                    local_version = version.value
+
+            step += num_envs
+            if step < random_steps:
+                action = env.sample_action()
+            else:  # explore as `Agent.action`
+                action = actor_ensemble.action(torch.from_numpy(obs)).numpy()
+
+            next_obs, reward, done, truncated, finished = env.step(action)
+
+            agent_reward += reward
+            # reward of each agent of the episodes finished in this step, of size (finished_num, agent_num)
+            finished_rewards = agent_reward[finished]
+            agent_reward[finished] = 0
+
+            transitions.put((obs, action, reward, next_obs, done, finished_rewards))
+            obs = env.obs
+        env.close()
+    except Exception as e:  # hand the error over to the learner instead of leaving it waiting forever
+        transitions.put(e)
+
+
+class RolloutPool:
+    """rollout processes that interact with the env using the actors published by the learner
+
+    each process steps its own env copies created by `env_fn`, and streams the experience through a queue,
+    so collecting experience and learning overlap instead of alternating.
+    the first `random_steps` steps of each process take random actions.
+    """
+
+    def __init__(self, env_fn, actors, obs_slices, num_workers, random_steps, queue_size=64):
+        # the learner copies the parameters of its actors here, the rollout processes copy them from here
+        self.actors = [deepcopy(actor).cpu().share_memory() for actor in actors]
+        self.version = mp.Value('l', 0, lock=False)  # guarded by `weights_lock`
+        self.weights_lock = mp.Lock()
+        self.transitions = mp.Queue(queue_size)
+        self.stop = mp.Event()
+
+        self.processes = []
+        for _ in range(num_workers):
+            process = mp.Process(target=_rollout, daemon=True,
+                                 args=(env_fn, self.actors, obs_slices, self.version, self.weights_lock,
+                                       self.transitions, self.stop, random_steps))
+            process.start()
+            self.processes.append(process)
+
+    def publish(self, actors):
+        """make the parameters of `actors` (of the learner, in the agent order) used by the rollout processes"""
+        with self.weights_lock:
+            for shared_actor, actor in zip(self.actors, actors):
+                shared_actor.load_state_dict(actor.state_dict())
+            self.version.value += 1
+
+    def get(self, block=False, max_num=64):
+        """at most `max_num` steps of experience, wait for at least one if `block`,
+        raise the error of a rollout process if it failed"""
+        items = []
+        try:
+            if block:
+                items.append(self.transitions.get())
+            while len(items) < max_num:
+                items.append(self.transitions.get_nowait())
+        except queue.Empty:
+            pass
+        for item in items:
+            if isinstance(item, Exception):
+                raise item
+        return items
+
+    def close(self):
+        self.stop.set()
+        # the processes can't exit until the experience they put is taken out of the queue
+        while any(process.is_alive() for process in self.processes):
+            self.get()
+            for process in self.processes:
+                process.join(timeout=0.01)
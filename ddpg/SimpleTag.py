@@ -0,0 +1,136 @@
+import numpy as np
+
+
+class SimpleTag:
+    """`simple_tag_v3` of pettingzoo (with discrete actions) simulated for `num_envs` worlds at a time in numpy
+
+    the state of all the worlds is kept in arrays, e.g. `pos` of size (num_envs, n_entities, 2),
+    the agents come first in the entities (adversaries then good agents), the obstacles last.
+    the observation layout and the rewards are those of `simple_tag_v3`, see parity_simple_tag.py.
+    it has the interface of `VectorEnv` (the joint layout of the agents),
+    all the worlds finish their episodes and are reset together.
+    """
+
+    # pettingzoo constants of the world
+    dt = 0.1
+    damping = 0.25
+    contact_force = 1e2
+    contact_margin = 1e-3
+    # force direction of the discrete actions: no_action, move_left, move_right, move_down, move_up
+    moves = np.array([[0, 0], [-1, 0], [1, 0], [0, -1], [0, 1]], dtype=float)
+
+    def __init__(self, num_envs, max_cycles=25, num_good=1, num_adversaries=3, num_obstacles=2, seed=None):
+        self.num_envs = num_envs
+        self.max_cycles = max_cycles
+        self.num_adversaries = num_adversaries
+        self.num_agents = num_adversaries + num_good
+        self.agents = [f'adversary_{i}' for i in range(num_adversaries)] + [f'agent_{i}' for i in range(num_good)]
+        self.np_random = np.random.default_rng(seed)
+
+        # properties of the entities
+        is_adversary = np.arange(self.num_agents) < num_adversaries
+        self.size = np.concatenate([np.where(is_adversary, 0.075, 0.05), np.full(num_obstacles, 0.2)])
+        self.accel = np.where(is_adversary, 3.0, 4.0)
+        self.max_speed = np.where(is_adversary, 1.0, 1.3)
+        self.dist_min = self.size[:, None] + self.size[None, :]
+
+        # entities each agent observes: the obstacles, the other agents, and the velocity of the other good agents
+        agent_index = np.arange(self.num_agents)
+        self.obstacles = np.arange(self.num_agents, self.num_agents + num_obstacles)
+        self.others = [agent_index[agent_index != i] for i in agent_index]
+        self.other_good = [agent_index[(agent_index != i) & ~is_adversary] for i in agent_index]
+        self.dim_info = {agent_id: [4 + 2 * (num_obstacles + len(self.others[i]) + len(self.other_good[i])),
+                                    len(self.moves)]
+                         for i, agent_id in enumerate(self.agents)}
+
+        self.pos = np.zeros((num_envs, self.num_agents + num_obstacles, 2))
+        self.vel = np.zeros((num_envs, self.num_agents, 2))  # the obstacles don't move
+        self.steps = 0
+        self.obs = None
+
+    def reset(self, seed=None):
+        if seed is not None:
+            self.np_random = np.random.default_rng(seed)
+        self.pos[:, :self.num_agents] = self.np_random.uniform(-1, 1, (self.num_envs, self.num_agents, 2))
+        self.pos[:, self.num_agents:] = self.np_random.uniform(-0.9, 0.9, (self.num_envs, len(self.obstacles), 2))
+        self.vel[:] = 0
+        self.steps = 0
+        self.obs = self.observe()
+        return self.obs
+
+    def sample_action(self):
+        """random actions of all the worlds"""
+        return self.np_random.integers(len(self.moves), size=(self.num_envs, self.num_agents))
+
+    def distance(self):
+        """distance between the agents and all the entities, of size (num_envs, num_agents, n_entities)"""
+        delta = self.pos[:, :self.num_agents, None] - self.pos[:, None, :]
+        return delta, np.sqrt(np.sum(np.square(delta), axis=-1))
+
+    def step(self, action):
+        """step all the worlds with `action` (of size (num_envs, agent_num)),
+        return next_obs, reward, done, truncated and `finished` (bool array of size num_envs) as `VectorEnv`"""
+        force = self.moves[action] * self.accel[:, None]
+
+        # softmax penetration of each pair of colliding entities, the force of an entity on itself is 0
+        delta, dist = self.distance()
+        agent_index = np.arange(self.num_agents)
+        dist[:, agent_index, agent_index] = np.inf
+        k = self.contact_margin
+        penetration = np.logaddexp(0, -(dist - self.dist_min[:self.num_agents]) / k) * k
+        force += np.sum(self.contact_force * delta / dist[..., None] * penetration[..., None], axis=2)
+
+        # integrate the state of the agents
+        self.pos[:, :self.num_agents] += self.vel * self.dt
+        self.vel *= 1 - self.damping
+        self.vel += force * self.dt  # the mass is 1
+        speed = np.sqrt(np.sum(np.square(self.vel), axis=-1, keepdims=True))
+        max_speed = self.max_speed[:, None]
+        over = speed > max_speed
+        self.vel = np.where(over, self.vel / np.where(over, speed, 1) * max_speed, self.vel)
+
+        reward = self.reward()
+        next_obs = self.observe()
+        self.steps += 1
+        finished = np.full(self.num_envs, self.steps >= self.max_cycles)
+        done = np.zeros((self.num_envs, self.num_agents), dtype=bool)  # never terminates
+        truncated = np.repeat(finished[:, None], self.num_agents, axis=1)
+        if self.steps >= self.max_cycles:
+            self.reset()
+        else:
+            self.obs = next_obs
+        return next_obs, reward, done, truncated, finished
+
+    def reward(self):
+        """reward of all the agents, of size (num_envs, agent_num)"""
+        # collisions of each adversary with each good agent, of size (num_envs, num_adversaries, num_good)
+        _, dist = self.distance()
+        adversaries, good = slice(self.num_adversaries), slice(self.num_adversaries, self.num_agents)
+        collision = dist[:, adversaries, good] < self.dist_min[adversaries, good]
+
+        # all the adversaries are rewarded for any collision
+        adversary_reward = 10.0 * np.sum(collision, axis=(1, 2))
+        # good agents are penalized for being hit, and for exiting the area
+        x = np.abs(self.pos[:, good])
+        bound = np.where(x < 0.9, 0, np.where(x < 1.0, (x - 0.9) * 10, np.minimum(np.exp(2 * x - 2), 10)))
+        good_reward = -10.0 * np.sum(collision, axis=1) - np.sum(bound, axis=-1)
+
+        reward = np.empty((self.num_envs, self.num_agents))
+        reward[:, adversaries] = adversary_reward[:, None]
+        reward[:, good] = good_reward
+        return reward
+
+    def observe(self):
+        """the joint obs, for each agent:
+        [self_vel, self_pos, obstacle_rel_positions, other_agent_rel_positions, other_good_agent_velocities]"""
+        obs = []
+        for i in range(self.num_agents):
+            rel_pos = self.pos - self.pos[:, i:i + 1]
+            obs += [self.vel[:, i], self.pos[:, i],
+                    rel_pos[:, self.obstacles].reshape(self.num_envs, -1),
+                    rel_pos[:, self.others[i]].reshape(self.num_envs, -1),
+                    self.vel[:, self.other_good[i]].reshape(self.num_envs, -1)]
+        return np.concatenate(obs, axis=1, dtype=np.float32)
+
+    def close(self):
+        pass
@@ -1,23 +1,22 @@
 from copy import deepcopy
-from typing import List
-
 import torch
 import torch.nn.functional as F
 from torch import nn, Tensor
 from torch.optim import Adam
 
+from Compiled import inference
+
 
 class Agent:
     """Agent that can interact with environment from pettingzoo"""
 
-    def __init__(self, obs_dim, act_dim, global_obs_dim, actor_lr, critic_lr):
+    def __init__(self, obs_dim, act_dim, global_obs_dim, actor_lr):
         self.actor = MLPNetwork(obs_dim, act_dim)
 
         # critic input all the observations and actions
         # if there are 3 agents for example, the input for critic is (obs1, obs2, obs3, act1, act2, act3)
         self.critic = MLPNetwork(global_obs_dim, 1)
         self.actor_optimizer = Adam(self.actor.parameters(), lr=actor_lr)
-        self.critic_optimizer = Adam(self.critic.parameters(), lr=critic_lr)
         self.target_actor = deepcopy(self.actor)
         self.target_critic = deepcopy(self.critic)
 
@@ -42,6 +41,7 @@ class Agent:
             return action, logits
         return action
 
+    @inference
     def target_action(self, obs):
         # when calculate target critic value in MADDPG,
         # we use target actor to get next action given next states,
@@ -50,14 +50,16 @@ class Agent:
         logits = self.target_actor(obs)  # torch.Size([batch_size, action_size])
         # action = self.gumbel_softmax(logits)
         action = F.gumbel_softmax(logits, hard=True)
-        return action.squeeze(0).detach()
+        return action.squeeze(0)
 
-    def critic_value(self, state_list: List[Tensor], act_list: List[Tensor]):
-        x = torch.cat(state_list + act_list, 1)
+    def critic_value(self, obs: Tensor, act: Tensor):
+        # the joint obs and joint action of all the agents
+        x = torch.cat((obs, act), 1)
         return self.critic(x).squeeze(1)  # tensor with a given length
 
-    def target_critic_value(self, state_list: List[Tensor], act_list: List[Tensor]):
-        x = torch.cat(state_list + act_list, 1)
+    @inference
+    def target_critic_value(self, obs: Tensor, act: Tensor):
+        x = torch.cat((obs, act), 1)
         return self.target_critic(x).squeeze(1)  # tensor with a given length
 
     def update_actor(self, loss):
@@ -66,12 +68,6 @@ class Agent:
         torch.nn.utils.clip_grad_norm_(self.actor.parameters(), 0.5)
         self.actor_optimizer.step()
 
-    def update_critic(self, loss):
-        self.critic_optimizer.zero_grad()
-        loss.backward()
-        torch.nn.utils.clip_grad_norm_(self.critic.parameters(), 0.5)
-        self.critic_optimizer.step()
-
 
 class MLPNetwork(nn.Module):
     def __init__(self, in_dim, out_dim, hidden_dim=64, non_linear=nn.ReLU()):
@@ -0,0 +1,161 @@
+import torch
+import torch.nn.functional as F
+from torch import nn
+from torch.optim import Adam
+
+from Compiled import inference
+
+
+def _pack(networks, requires_grad=False):
+    """pack the parameters of `networks` (sequential modules of the same shape) into stacked tensors,
+    e.g. the weights of a linear layer of 3 networks are a tensor of size (3, out_dim, in_dim).
+    the parameters of each network become views of their slice, so they can still be trained, saved and loaded
+    as before, and the stack always holds their current value without copying them.
+    return the layers: (weight, bias) for a linear layer, or the module itself if it is element-wise"""
+    layers = []
+    for modules in zip(*networks):
+        if isinstance(modules[0], nn.Linear):
+            weight = torch.stack([m.weight.data for m in modules])
+            bias = torch.stack([m.bias.data for m in modules]).unsqueeze(1)
+            if requires_grad:
+                weight, bias = nn.Parameter(weight), nn.Parameter(bias)
+            for g, m in enumerate(modules):
+                m.weight.data = weight.data[g]
+                m.bias.data = bias.data[g, 0]
+            layers.append((weight, bias))
+        else:  # element-wise, e.g. activation
+            layers.append(modules[0])
+    return layers
+
+
+def _forward(layers, x):
+    """evaluate the packed networks on `x` of size (network_num, batch_size, in_dim) with batched matmul"""
+    for layer in layers:
+        if isinstance(layer, tuple):
+            weight, bias = layer
+            x = torch.baddbmm(bias, x, weight.transpose(1, 2))
+        else:
+            x = layer(x)
+    return x
+
+
+def append_agent_id(x):
+    """append the one-hot id of each agent to its input `x` of size (agent_num, batch_size, in_dim)"""
+    agent_num, batch_size = x.shape[:2]
+    agent_id = torch.eye(agent_num, dtype=x.dtype, device=x.device).unsqueeze(1)
+    return torch.cat((x, agent_id.expand(agent_num, batch_size, agent_num)), dim=-1)
+
+
+def _group(networks, requires_grad=False):
+    """group the agents of `networks` (the network of each agent) to be evaluated together,
+    return (index of the agents, layers) of each group, the layers are packed (see `_pack`) for the networks of
+    the same shape, or the network itself if it is shared by several agents (see `MADDPG` share_params)"""
+    groups = {}
+    for i, network in enumerate(networks):
+        if sum(n is network for n in networks) > 1:
+            key = id(network)
+        else:
+            key = tuple((type(m), tuple(p.shape for p in m.parameters())) for m in network.net)
+        groups.setdefault(key, []).append(i)
+
+    layers = []
+    for index in groups.values():
+        if len(index) > 1 and networks[index[0]] is networks[index[1]]:
+            layers.append(networks[index[0]].net)
+        else:
+            layers.append(_pack([networks[i].net for i in index], requires_grad))
+    return list(zip(groups.values(), layers))
+
+
+def _evaluate(layers, x, agent_id_input=False):
+    """evaluate a group of `_group` on `x` of size (group_size, batch_size, in_dim)"""
+    if isinstance(layers, nn.Module):  # shared by the group
+        return layers(append_agent_id(x) if agent_id_input else x)
+    return _forward(layers, x)
+
+
+class ActorEnsemble:
+    """evaluate the actors of all the agents in one pass, with a batched matmul for the actors of the same shape
+
+    the parameters of the actors of the same shape are packed into stacked tensors, see `_pack`.
+    an actor shared by several agents takes their obs at a time, with their one-hot id if `agent_id_input`.
+    `obs_slices` is the block of each actor in the joint obs, as `Buffer.obs_slices`.
+    """
+
+    def __init__(self, actors, obs_slices, agent_id_input=False):
+        self.agent_num = len(actors)
+        self.agent_id_input = agent_id_input
+        self.groups = []  # (index of the actors, their obs slices, layers)
+        for index, layers in _group(actors):  # actors with the same layers are grouped together
+            self.groups.append((index, [obs_slices[i] for i in index], layers))
+
+    def _forward(self, obs):
+        """logits of each group of actors given the joint obs (of size (batch_size, sum of obs_dim)),
+        of size (group_size, batch_size, act_dim)"""
+        for index, obs_slices, layers in self.groups:
+            x = torch.stack([obs[:, s] for s in obs_slices])  # torch.Size([group_size, batch_size, obs_dim])
+            yield index, _evaluate(layers, x, self.agent_id_input)
+
+    @inference
+    def action(self, obs):
+        """sample the action of all the agents as `Agent.action`, as int of size (batch_size, agent_num)"""
+        action = torch.empty(obs.shape[0], self.agent_num, dtype=torch.long)
+        for index, logits in self._forward(obs):
+            action[:, index] = F.gumbel_softmax(logits, hard=True).argmax(dim=-1).T
+        return action
+
+
+class CriticEnsemble:
+    """the critics of all the agents, evaluated and trained together
+
+    the parameters of the critics and of the target critics of the same shape are packed into stacked tensors,
+    see `_pack`, a critic shared by several agents takes their input at a time, as `ActorEnsemble`.
+    a single Adam optimizer updates the parameters, which is element-wise the same as an optimizer
+    for each critic, and the gradient is clipped by the norm of each critic, as `clip_grad_norm_` on it.
+    """
+
+    def __init__(self, critics, target_critics, lr, max_norm=0.5, agent_id_input=False):
+        self.agent_num = len(critics)
+        self.agent_id_input = agent_id_input
+        self.groups = _group(critics, requires_grad=True)
+        self.target_groups = _group(target_critics)
+        # the parameters of each group, stacked for packed networks, whose gradient is clipped by each slice
+        self.param_groups = []
+        for _, layers in self.groups:
+            if isinstance(layers, nn.Module):
+                self.param_groups.append((list(layers.parameters()), False))
+            else:
+                self.param_groups.append(([p for layer in layers if isinstance(layer, tuple) for p in layer], True))
+        self.params = [p for params, _ in self.param_groups for p in params]
+        self.optimizer = Adam(self.params, lr=lr)
+        self.max_norm = max_norm
+
+    def _evaluate(self, groups, x):
+        if len(groups) == 1:  # the critics of all the agents are evaluated together, in the agent order
+            return _evaluate(groups[0][1], x, self.agent_id_input).squeeze(-1)
+        value = x.new_empty(x.shape[:2])
+        for index, layers in groups:
+            value[index] = _evaluate(layers, x[index], self.agent_id_input).squeeze(-1)
+        return value
+
+    def value(self, x):
+        """value of each critic given its input, `x` is of size (critic_num, batch_size, in_dim)"""
+        return self._evaluate(self.groups, x)
+
+    @inference
+    def target_value(self, x):
+        return self._evaluate(self.target_groups, x)
+
+    def update(self, loss):
+        """`loss` is the sum of the loss of each critic"""
+        self.optimizer.zero_grad()
+        loss.backward()
+        for params, stacked in self.param_groups:
+            if stacked:  # the gradient norm of each critic, of size (critic_num)
+                norm = torch.stack([p.grad.flatten(1).norm(dim=1) for p in params]).norm(dim=0)
+            else:
+                norm = torch.stack([p.grad.norm() for p in params]).norm()
+            clip_coef = (self.max_norm / (norm + 1e-6)).clamp(max=1.0)
+            for p in params:
+                p.grad.mul_(clip_coef.view(-1, *[1] * (p.dim() - 1)) if stacked else clip_coef)
+        self.optimizer.step()
@@ -1,13 +1,20 @@
 import logging
 import os
 import pickle
+import threading
+import time
 
 import numpy as np
 import torch
 import torch.nn.functional as F
 
-from Agent import Agent
-from Buffer import Buffer
+from Agent import Agent, MLPNetwork
+from Buffer import Buffer, MemmapBuffer
+from Compiled import Compiled, inference
+from Ensemble import ActorEnsemble, CriticEnsemble, append_agent_id
+from Prefetcher import Prefetcher
+from Sampler import get_sampler
+from Telemetry import ActionTelemetry
 
 
 def setup_logger(filename):
@@ -25,107 +32,284 @@ def setup_logger(filename):
     return logger
 
 
+def weighted_mse_loss(value, target, weights):
+    """mse loss scaled by the importance-sampling `weights` of each sample, plain mse loss if `weights` is None"""
+    if weights is None:
+        return F.mse_loss(value, target, reduction='mean')
+    return (weights * (value - target) ** 2).mean()
+
+
 class MADDPG:
     """A MADDPG(Multi Agent Deep Deterministic Policy Gradient) agent"""
 
-    def __init__(self, dim_info, capacity, batch_size, actor_lr, critic_lr, res_dir):
+    def __init__(self, dim_info, capacity, batch_size, actor_lr, critic_lr, res_dir, sampler='unique', buffer_dir=None,
+                 dedup_obs=False, obs_dtype='float32', prefetch=0, independent_samples=False, compiled=False,
+                 updates_per_learn=1, action_log_interval=1, share_params=False, agent_id_input=False,
+                 **sampler_kwargs):
         # sum all the dims of each agent to get input dim for critic
         global_obs_act_dim = sum(sum(val) for val in dim_info.values())
-        # create Agent(actor-critic) and replay buffer for each agent
-        self.agents = {}
-        self.buffers = {}
-        for agent_id, (obs_dim, act_dim) in dim_info.items():
-            self.agents[agent_id] = Agent(obs_dim, act_dim, global_obs_act_dim, actor_lr, critic_lr)
-            self.buffers[agent_id] = Buffer(capacity, obs_dim, act_dim, 'cpu')
+        # if `share_params`, the agents of a role (e.g. `adversary_0`, `adversary_1`, ...) share one Agent,
+        # whose networks take the input of all of them at a time, and learn from the experience of all of them,
+        # with the one-hot id of the agent in its role appended to the input if `agent_id_input`
+        self.agent_id_input = share_params and agent_id_input
+        roles = {}
+        for agent_id in dim_info:
+            roles.setdefault(agent_id.rsplit('_', 1)[0] if share_params else agent_id, []).append(agent_id)
+        # create Agent(actor-critic) for each role, i.e. each agent if not `share_params`
+        self.roles = []  # (index of the agents, their Agent) of each role
+        role_agents = {}
+        for agent_ids in roles.values():
+            obs_dim, act_dim = dim_info[agent_ids[0]]
+            assert all(dim_info[agent_id] == dim_info[agent_ids[0]] for agent_id in agent_ids), \
+                f'the agents of a role should have the same dims, {agent_ids} are not'
+            # the one-hot id of an agent alone in its role is the same as a bias
+            id_dim = len(agent_ids) if self.agent_id_input and len(agent_ids) > 1 else 0
+            agent = Agent(obs_dim + id_dim, act_dim, global_obs_act_dim + id_dim, actor_lr)
+            role_agents.update(dict.fromkeys(agent_ids, agent))
+            self.roles.append(([list(dim_info).index(agent_id) for agent_id in agent_ids], agent))
+        self.agents = {agent_id: role_agents[agent_id] for agent_id in dim_info}
+        # the parameters of the networks and of their target networks, in the same order, see `update_target`
+        networks = [(agent.actor, agent.target_actor) for _, agent in self.roles]
+        networks += [(agent.critic, agent.target_critic) for _, agent in self.roles]
+        self.network_params = [p for network, _ in networks for p in network.parameters()]
+        self.target_params = [p for _, target_network in networks for p in target_network.parameters()]
+        # a single replay buffer stores the experience of all the agents,
+        # it is kept in memory-mapped files under `buffer_dir` if specified
+        if buffer_dir is None:
+            self.buffer = Buffer(capacity, dim_info, 'cpu', dedup_obs, obs_dtype)
+        else:
+            self.buffer = MemmapBuffer(capacity, dim_info, 'cpu', buffer_dir, dedup_obs, obs_dtype)
+        # decide which transitions are sampled from the buffer, the experience of a resumed buffer counts as new
+        self.sampler = get_sampler(sampler, capacity, **sampler_kwargs)
+        self.sampler.add(np.arange(len(self.buffer)))
+        # select the actions of all the agents in one pass, the actors of the same shape are evaluated together
+        self.actor_ensemble = ActorEnsemble([agent.actor for agent in self.agents.values()], self.buffer.obs_slices,
+                                            self.agent_id_input)
+        # the critics of all the agents take the same joint input, they are evaluated and trained in one pass
+        self.critic_ensemble = CriticEnsemble([agent.critic for agent in self.agents.values()],
+                                              [agent.target_critic for agent in self.agents.values()], critic_lr,
+                                              agent_id_input=self.agent_id_input)
+        # if `prefetch` > 0, batches are gathered into `prefetch` slots ahead of time in a background thread,
+        # which is started at the first `sample`, `lock` guards the buffer and the sampler shared with it
+        self.prefetch = prefetch
+        self.prefetcher = None
+        self.lock = threading.Lock()
+        self.sample_wait = 0  # total time the learner waits for sampled batches
+        # by default all the updates of a learn step share one batch and its target actions,
+        # if `independent_samples`, each update samples its own batch
+        self.independent_samples = independent_samples
+        # a learn call runs `updates_per_learn` updates, whose batches are gathered at once, see `sample`
+        self.updates_per_learn = updates_per_learn
+        self.batches = []  # the minibatches gathered and not taken yet
+        # if `compiled`, the computation of the learn step is compiled into graphs, see `Compiled`
+        if compiled:
+            self.target_actions = Compiled(self.target_actions)
+            self.critic_loss = Compiled(self.critic_loss)
+            self.actor_loss = Compiled(self.actor_loss)
         self.dim_info = dim_info
 
         self.batch_size = batch_size
         self.res_dir = res_dir  # directory to save the training result
         self.logger = setup_logger(os.path.join(res_dir, 'maddpg.log'))
+        # the actions of every `action_log_interval`-th step are recorded to `res_dir`, see `ActionTelemetry`,
+        # which is started at the first `select_action`, 0 not to record them
+        self.action_log_interval = action_log_interval
+        self.telemetry = None
 
     def add(self, obs, action, reward, next_obs, done):
-        # NOTE that the experience is a dict with agent name as its key
-        for agent_id in obs.keys():
-            o = obs[agent_id]
+        # NOTE that the experience is in the joint layout of the agents, stacked over env copies (see `VectorEnv`),
+        # the action is an int of each agent, it is stored as it is and only converted to onehot when sampled
+        with self.lock:
+            index = self.buffer.add(obs, action, reward, next_obs, done)
+            self.sampler.add(index)
 
-            a = action[agent_id]
-            if isinstance(a, int):
-                # the action from env.action_space.sample() is int, we have to convert it to onehot
-                a = np.eye(self.dim_info[agent_id][1])[a]
-
-            r = reward[agent_id]
-            next_o = next_obs[agent_id]
-            d = done[agent_id]
-            self.buffers[agent_id].add(o, a, r, next_o, d)
+    def gather(self, batch_size):
+        """gather `batch_size` transitions from the shared buffer: (obs, action, reward, next_obs, done), indices,
+        and their importance-sampling weights"""
+        if self.prefetch:
+            if self.prefetcher is None:
+                self.prefetcher = Prefetcher(self.buffer, self.sampler, batch_size, self.lock, self.prefetch)
+            batch, indices, weights = self.prefetcher.get()
+            self.sample_wait = self.prefetcher.wait_time
+        else:
+            start = time.perf_counter()
+            total_num = len(self.buffer)
+            indices = self.sampler.sample(total_num, batch_size)
+            weights = self.sampler.weights(total_num, indices)
+            batch = self.buffer.sample(indices)
+            self.sample_wait += time.perf_counter() - start
+        return batch, indices, weights
 
     def sample(self, batch_size):
-        """sample experience from all the agents' buffers, and collect data for network input"""
-        # get the total num of transitions, these buffers should have same number of transitions
-        total_num = len(self.buffers['agent_0'])
-        indices = np.random.choice(total_num, size=batch_size, replace=False)
-
+        """sample experience from the shared buffer, and collect data for network input"""
         # NOTE that in MADDPG, we need the obs and actions of all agents
         # but only the reward and done of the current agent is needed in the calculation
-        obs, act, reward, next_obs, done, next_act = {}, {}, {}, {}, {}, {}
-        for agent_id, buffer in self.buffers.items():
-            o, a, r, n_o, d = buffer.sample(indices)
-            obs[agent_id] = o
-            act[agent_id] = a
-            reward[agent_id] = r
-            next_obs[agent_id] = n_o
-            done[agent_id] = d
-            # calculate next_action using target_network and next_state
-            next_act[agent_id] = self.agents[agent_id].target_action(n_o)
-
-        return obs, act, reward, next_obs, done, next_act
+        if not self.batches:
+            # the batches of `updates_per_learn` updates are gathered from the buffer at once and sliced into
+            # minibatches taken in turn, NOTE that a prefetched batch is in use until all its minibatches are taken
+            batch, indices, weights = self.gather(batch_size * self.updates_per_learn)
+            for k in reversed(range(self.updates_per_learn)):
+                s = slice(k * batch_size, (k + 1) * batch_size)
+                self.batches.append(([x[s] for x in batch], indices[s], None if weights is None else weights[s]))
+        (o, a, r, n_o, d), indices, weights = self.batches.pop()
+        if weights is not None:
+            weights = torch.from_numpy(weights).to(self.buffer.device)
+
+        # the batch is in the joint layout of the agents, e.g. obs is of size (batch_size, sum of obs_dim),
+        # the block of an agent is `self.buffer.obs_slices[i]`, reward is of size (batch_size, agent_num)
+        # calculate next_action using target_network and next_state
+        next_a = self.target_actions(n_o)
+
+        # `indices` and `weights` are needed for prioritized replay
+        return o, a, r, n_o, d, next_a, indices, weights
+
+    def replace_action(self, act, i, action):
+        """the joint action `act` with the block of the `i`-th agent replaced by `action`"""
+        s = self.buffer.act_slices[i]
+        return torch.cat((act[:, :s.start], action, act[:, s.stop:]), dim=1)
+
+    def actor_input(self, index, obs):
+        """the input of the actor of the agents `index` (of a role) given the joint obs, or a joint obs of each agent,
+        i.e. their obs (with their one-hot id if `agent_id_input`) stacked, of size (len(index) * batch_size, in_dim)"""
+        x = torch.stack([(obs[i] if obs.dim() == 3 else obs)[:, self.buffer.obs_slices[i]] for i in index])
+        if self.agent_id_input and len(index) > 1:
+            x = append_agent_id(x)
+        return x.flatten(0, 1)
+
+    @inference
+    def target_actions(self, next_obs):
+        """the joint next action of all the agents by their target actors, given the joint next obs"""
+        next_act = [None] * len(self.agents)
+        for index, agent in self.roles:
+            action = agent.target_action(self.actor_input(index, next_obs)).view(len(index), len(next_obs), -1)
+            for j, i in enumerate(index):
+                next_act[i] = action[j]
+        return torch.cat(next_act, dim=1)
 
     def select_action(self, obs):
-        actions = {}
-        for agent, o in obs.items():
-            o = torch.from_numpy(o).unsqueeze(0).float()
-            a = self.agents[agent].action(o)  # torch.Size([1, action_size])
-            # NOTE that the output is a tensor, convert it to int before input to the environment
-            actions[agent] = a.squeeze(0).argmax().item()
-            self.logger.info(f'{agent} action: {actions[agent]}')
-        return actions
+        # the joint obs is either of a single env or stacked over env copies,
+        # the action is an int of each agent, of size (agent_num) or (num_envs, agent_num) accordingly
+        o = torch.from_numpy(np.atleast_2d(obs)).float()
+        actions = self.actor_ensemble.action(o).numpy()
+        self.record_actions(actions)
+        return actions if obs.ndim > 1 else actions[0]
+
+    def record_actions(self, actions):
+        """record the actions selected for the env, by `select_action` or by the rollout processes"""
+        if self.action_log_interval:
+            if self.telemetry is None:
+                self.telemetry = ActionTelemetry(os.path.join(self.res_dir, 'actions.bin'), self.dim_info,
+                                                 self.action_log_interval)
+            self.telemetry.record(actions)
+
+    def critic_loss(self, x, next_x, reward, done, weights, gamma):
+        """the sum of the loss of the critics given their input (see `learn`), and their TD errors"""
+        critic_value = self.critic_ensemble.value(x)
+        # calculate target critic value
+        next_target_critic_value = self.critic_ensemble.target_value(next_x)
+        target_value = reward + gamma * next_target_critic_value * (1 - done)
+
+        # the loss of each critic only depends on its own parameters, so their sum is minimized together
+        critic_loss = sum(weighted_mse_loss(v, t, w) for v, t, w in zip(critic_value, target_value, weights))
+        return critic_loss, (target_value - critic_value).detach()
+
+    def actor_loss(self, x):
+        """the sum of the loss of the actors, each given the input of its critic"""
+        # action of the current agent is calculated using its actor, the agents of a role at a time
+        obs_dim = self.buffer.obs_slices[-1].stop
+        obs, act = x[:, :, :obs_dim], x[:, :, obs_dim:]
+        actor_x, actor_loss_pse = [None] * len(self.agents), 0
+        for index, agent in self.roles:
+            action, logits = agent.action(self.actor_input(index, obs), model_out=True)
+            action = action.view(len(index), x.shape[1], -1)
+            for j, i in enumerate(index):
+                actor_x[i] = torch.cat((obs[i], self.replace_action(act[i], i, action[j])), 1)
+            actor_loss_pse = actor_loss_pse + torch.pow(logits, 2).mean() * len(index)
+        actor_loss = -self.critic_ensemble.value(torch.stack(actor_x)).mean(dim=1).sum()
+        return actor_loss + 1e-3 * actor_loss_pse
 
     def learn(self, batch_size, gamma):
-        for agent_id, agent in self.agents.items():
-            obs, act, reward, next_obs, done, next_act = self.sample(batch_size)
-            # update critic
-            critic_value = agent.critic_value(list(obs.values()), list(act.values()))
-
-            # calculate target critic value
-            next_target_critic_value = agent.target_critic_value(list(next_obs.values()),
-                                                                 list(next_act.values()))
-            target_value = reward[agent_id] + gamma * next_target_critic_value * (1 - done[agent_id])
-
-            critic_loss = F.mse_loss(critic_value, target_value.detach(), reduction='mean')
-            agent.update_critic(critic_loss)
-
-            # update actor
-            # action of the current agent is calculated using its actor
-            action, logits = agent.action(obs[agent_id], model_out=True)
-            act[agent_id] = action
-            actor_loss = -agent.critic_value(list(obs.values()), list(act.values())).mean()
-            actor_loss_pse = torch.pow(logits, 2).mean()
-            agent.update_actor(actor_loss + 1e-3 * actor_loss_pse)
-            # self.logger.info(f'agent{i}: critic loss: {critic_loss.item()}, actor loss: {actor_loss.item()}')
+        # the critics are evaluated together on the batch of each agent,
+        # i.e. the input of the critics is of size (agent_num, batch_size, sum of obs_dim and act_dim)
+        agent_num = len(self.agents)
+        if self.independent_samples:  # each agent learns from its own batch, the batches are stacked
+            x, next_x, reward, done, indices, weights = [], [], [], [], [], []
+            for i in range(agent_num):
+                obs, act, r, next_obs, d, next_act, index, w = self.sample(batch_size)
+                # NOTE that a prefetched batch is reused after the next `sample`, so copy what is needed
+                x.append(torch.cat((obs, act), 1))
+                next_x.append(torch.cat((next_obs, next_act), 1))
+                reward.append(r[:, i].clone())
+                done.append(d[:, i].clone())
+                indices.append(index)
+                weights.append(w)
+            x, next_x, reward, done = torch.stack(x), torch.stack(next_x), torch.stack(reward), torch.stack(done)
+        else:  # all the agents learn from the same batch, which is expanded without copying
+            obs, act, r, next_obs, d, next_act, index, w = self.sample(batch_size)
+            x = torch.cat((obs, act), 1).expand(agent_num, -1, -1)
+            next_x = torch.cat((next_obs, next_act), 1).expand(agent_num, -1, -1)
+            reward, done = r.T, d.T
+            indices, weights = [index] * agent_num, [w] * agent_num
+
+        # update critic
+        critic_loss, td_error = self.critic_loss(x, next_x, reward, done, weights, gamma)
+        self.critic_ensemble.update(critic_loss)
+        # TD errors are the new priorities of the sampled transitions
+        td_error = td_error.cpu().numpy()
+        with self.lock:
+            if self.independent_samples:
+                for index, td in zip(indices, td_error):
+                    self.sampler.update(index, td)
+            else:  # take the largest one of the critics
+                self.sampler.update(indices[0], np.abs(td_error).max(axis=0))
+
+        # update actor
+        actor_loss = self.actor_loss(x)
+        # the loss of each actor only depends on its own parameters, as the critic loss
+        for _, agent in self.roles:
+            agent.actor_optimizer.zero_grad()
+        actor_loss.backward()
+        for _, agent in self.roles:
+            torch.nn.utils.clip_grad_norm_(agent.actor.parameters(), 0.5)
+            agent.actor_optimizer.step()
+        # self.logger.info(f'critic loss: {critic_loss.item()}, actor loss: {actor_loss.item()}')
 
     def update_target(self, tau):
-        def soft_update(from_network, to_network):
-            """ copy the parameters of `from_network` to `to_network` with a proportion of tau"""
-            for from_p, to_p in zip(from_network.parameters(), to_network.parameters()):
-                to_p.data.copy_(tau * from_p.data + (1.0 - tau) * to_p.data)
+        """move the parameters of the target networks towards those of the networks with a proportion of `tau`,
+        all of them in a single foreach call, which copies them if `tau` is 1"""
+        with torch.no_grad():
+            if tau == 1:
+                torch._foreach_copy_(self.target_params, self.network_params)
+            else:
+                torch._foreach_lerp_(self.target_params, self.network_params, tau)
 
-        for agent in self.agents.values():
-            soft_update(agent.actor, agent.target_actor)
-            soft_update(agent.critic, agent.target_critic)
+    def actors(self):
+        """the actor of each agent in the agent order, which only takes the obs of the agent,
+        an actor shared by a role with `agent_id_input` is copied for each agent, with its id folded into the bias"""
+        if not self.agent_id_input:
+            return [agent.actor for agent in self.agents.values()]
+        actors = [None] * len(self.agents)
+        for index, agent in self.roles:
+            for j, i in enumerate(index):
+                if len(index) == 1:
+                    actors[i] = agent.actor
+                    continue
+                # the one-hot id only adds a column of the weight of the first layer to its bias
+                state_dict = agent.actor.state_dict()
+                obs_dim, act_dim = self.dim_info[list(self.agents)[i]]
+                state_dict['net.0.bias'] = state_dict['net.0.bias'] + state_dict['net.0.weight'][:, obs_dim + j]
+                state_dict['net.0.weight'] = state_dict['net.0.weight'][:, :obs_dim]
+                actors[i] = MLPNetwork(obs_dim, act_dim)
+                actors[i].load_state_dict(state_dict)
+        return actors
 
     def save(self, reward):
         """save actor parameters of all agents and training reward to `res_dir`"""
+        self.buffer.flush()
+        if self.telemetry is not None:
+            self.telemetry.flush()
         torch.save(
-            {name: agent.actor.state_dict() for name, agent in self.agents.items()},  # actor parameter
+            {name: actor.state_dict() for name, actor in zip(self.agents, self.actors())},  # actor parameter
             os.path.join(self.res_dir, 'model.pt')
         )
         with open(os.path.join(self.res_dir, 'rewards.pkl'), 'wb') as f:  # save training data
@@ -134,7 +318,8 @@ class MADDPG:
     @classmethod
     def load(cls, dim_info, file):
         """init maddpg using the model saved in `file`"""
-        instance = cls(dim_info, 0, 0, 0, 0, os.path.dirname(file))
+        # the actions selected by a loaded model are not recorded, `res_dir` holds the telemetry of the training
+        instance = cls(dim_info, 0, 0, 0, 0, os.path.dirname(file), action_log_interval=0)
         data = torch.load(file)
         for agent_id, agent in instance.agents.items():
             agent.actor.load_state_dict(data[agent_id])
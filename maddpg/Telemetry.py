@@ -0,0 +1,73 @@
+import logging
+import threading
+
+import numpy as np
+
+
+class ActionTelemetry:
+    """record the actions selected for the env, and write them to disk in a background thread
+
+    the actions of every `interval`-th call of `record` are copied into a ring of `capacity` preallocated rows,
+    a row is the action (an int) of each agent of an env copy. every `flush_interval` seconds, the rows recorded
+    since the last flush are appended to `file` as uint8, which can be read with
+    `np.fromfile(file, np.uint8).reshape(-1, agent_num)`, and a histogram of the actions of each agent is logged.
+    rows are dropped (and counted) if more than `capacity` of them are recorded between two flushes.
+    """
+
+    def __init__(self, file, dim_info, interval=1, capacity=1 << 16, flush_interval=1.0):
+        self.file = file
+        self.agents = list(dim_info)
+        self.act_dims = [act_dim for _, act_dim in dim_info.values()]
+        self.interval = interval
+        self.ring = np.zeros((capacity, len(self.agents)), dtype=np.uint8)
+        self.calls = 0  # calls of `record`
+        self.head = 0  # number of rows recorded
+        self.tail = 0  # number of rows flushed or dropped
+        self.dropped = 0
+        self.lock = threading.Lock()  # guards the ring, held only to copy rows in and out
+        self.flush_lock = threading.Lock()  # flushes one at a time, e.g. the thread and `MADDPG.save`
+
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, args=(flush_interval,), daemon=True)
+        self._thread.start()
+
+    def record(self, actions):
+        """record `actions`, of size (agent_num) or (num_envs, agent_num), if it is the turn of this call"""
+        self.calls += 1
+        if self.calls % self.interval:
+            return
+        rows = np.atleast_2d(actions)
+        with self.lock:
+            start = self.head % len(self.ring)
+            if start + len(rows) <= len(self.ring):
+                self.ring[start:start + len(rows)] = rows
+            else:
+                self.ring[(start + np.arange(len(rows))) % len(self.ring)] = rows
+            self.head += len(rows)
+
+    def _run(self, flush_interval):
+        while not self._stop.wait(flush_interval):
+            self.flush()
+
+    def flush(self):
+        """append the rows recorded since the last flush to `file`, and log their histogram"""
+        with self.flush_lock:
+            with self.lock:
+                if self.head - self.tail > len(self.ring):  # overwritten before being flushed
+                    self.dropped += self.head - self.tail - len(self.ring)
+                    self.tail = self.head - len(self.ring)
+                rows = self.ring[np.arange(self.tail, self.head) % len(self.ring)]
+                self.tail = self.head
+            if not len(rows):
+                return
+            with open(self.file, 'ab') as f:
+                rows.tofile(f)
+            histogram = '; '.join(f'{agent_id}: {np.bincount(rows[:, i], minlength=act_dim).tolist()}'
+                                  for i, (agent_id, act_dim) in enumerate(zip(self.agents, self.act_dims)))
+            logging.info(f'actions of {len(rows)} steps ({self.dropped} dropped so far): {histogram}')
+
+    def close(self):
+        """stop the thread and flush the remaining rows"""
+        self._stop.set()
+        self._thread.join()
+        self.flush()
@@ -0,0 +1,49 @@
+import argparse
+import timeit
+
+import numpy as np
+import torch
+
+from Agent import Agent
+from Buffer import Buffer
+from Ensemble import ActorEnsemble
+from main import get_env
+
+
+def select_action_loop(agents, obs_slices, obs):
+    """the action selection before the ensemble, one forward pass for each agent, as a baseline"""
+    actions = []
+    for agent, s in zip(agents, obs_slices):
+        o = torch.from_numpy(np.atleast_2d(obs[..., s])).float()
+        actions.append(agent.action(o).argmax(dim=1))
+    return torch.stack(actions, dim=1).numpy()
+
+
+def select_action_ensemble(ensemble, obs):
+    return ensemble.action(torch.from_numpy(np.atleast_2d(obs)).float()).numpy()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('env_name', type=str, nargs='?', default='simple_tag_v3', help='name of the env')
+    parser.add_argument('--repeat', type=int, default=2000, help='action selections measured for each batch size')
+    parser.add_argument('--num_envs', type=int, nargs='+', default=[1, 16, 256],
+                        help='number of env copies the actions are selected for at a time')
+    args = parser.parse_args()
+
+    torch.set_num_threads(1)  # as in the rollout processes
+    _, dim_info = get_env(args.env_name)
+    global_obs_act_dim = sum(sum(val) for val in dim_info.values())
+    agents = [Agent(obs_dim, act_dim, global_obs_act_dim, 0.01) for obs_dim, act_dim in dim_info.values()]
+    obs_slices = Buffer._slices([obs_dim for obs_dim, _ in dim_info.values()])
+    ensemble = ActorEnsemble([agent.actor for agent in agents], obs_slices)
+
+    # latency of selecting the actions of all the agents for one step (in microseconds)
+    print(f'{"num_envs":>10}{"loop":>12}{"ensemble":>12}{"speedup":>10}')
+    for num_envs in args.num_envs:
+        obs = np.random.randn(num_envs, obs_slices[-1].stop).astype(np.float32)
+        if num_envs == 1:
+            obs = obs[0]  # a single env, as in evaluate.py
+        loop = timeit.timeit(lambda: select_action_loop(agents, obs_slices, obs), number=args.repeat) / args.repeat
+        batched = timeit.timeit(lambda: select_action_ensemble(ensemble, obs), number=args.repeat) / args.repeat
+        print(f'{num_envs:>10}{loop * 1e6:>10.1f}us{batched * 1e6:>10.1f}us{loop / batched:>9.2f}x')
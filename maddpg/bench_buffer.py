@@ -0,0 +1,61 @@
+import argparse
+import timeit
+
+import numpy as np
+
+from Buffer import Buffer
+from main import get_env
+from VectorEnv import join, join_obs
+
+
+def collect(env_name, ep_len, step_num):
+    """collect `step_num` transitions of random actions, as in the warm-up of main.py"""
+    env, dim_info = get_env(env_name, ep_len)
+    transitions = []
+    while len(transitions) < step_num:
+        obs, info = env.reset()
+        while env.agents:
+            action = {agent_id: env.action_space(agent_id).sample() for agent_id in env.agents}
+            next_obs, reward, done, truncated, info = env.step(action)
+            transitions.append([join_obs(obs, dim_info), join(action, dim_info), join(reward, dim_info),
+                                join_obs(next_obs, dim_info), join(done, dim_info)])
+            obs = next_obs
+    return dim_info, transitions[:step_num]
+
+
+def buffer_bytes(buffer):
+    """memory taken by all the arrays of the buffer"""
+    return sum(val.nbytes for val in vars(buffer).values() if isinstance(val, np.ndarray))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('env_name', type=str, nargs='?', default='simple_tag_v3', help='name of the env')
+    parser.add_argument('--episode_length', type=int, default=25, help='steps per episode')
+    parser.add_argument('--buffer_capacity', type=int, default=20000, help='capacity of replay buffer')
+    parser.add_argument('--batch_size', type=int, default=1024, help='batch-size of replay buffer')
+    parser.add_argument('--repeat', type=int, default=200, help='sample calls measured for each mode')
+    args = parser.parse_args()
+
+    dim_info, transitions = collect(args.env_name, args.episode_length, args.buffer_capacity)
+    indices = [np.random.randint(args.buffer_capacity, size=args.batch_size) for _ in range(args.repeat)]
+
+    reference = None
+    print(f'{"obs_dtype":>10}{"dedup_obs":>10}{"bytes/transition":>18}{"sample":>12}{"max obs error":>15}')
+    for dedup_obs in (False, True):
+        for obs_dtype in Buffer.obs_dtypes:
+            buffer = Buffer(args.buffer_capacity, dim_info, 'cpu', dedup_obs, obs_dtype)
+            for transition in transitions:
+                buffer.add(*transition)
+
+            batches = iter(indices)
+            cost = timeit.timeit(lambda: buffer.sample(next(batches)), number=args.repeat) / args.repeat
+
+            # error of the obs and next_obs compared to the float32 buffer without de-duplication
+            obs, _, _, next_obs, _ = buffer.sample(indices[0])
+            if reference is None:
+                reference = obs, next_obs
+            error = max((obs - reference[0]).abs().max().item(), (next_obs - reference[1]).abs().max().item())
+
+            size = buffer_bytes(buffer) / args.buffer_capacity
+            print(f'{obs_dtype:>10}{str(dedup_obs):>10}{size:>18.1f}{cost * 1e6:>10.1f}us{error:>15.5f}')
@@ -0,0 +1,49 @@
+import argparse
+import tempfile
+import time
+import timeit
+
+import numpy as np
+import torch
+
+from MADDPG import MADDPG
+from main import get_env
+
+
+def make_maddpg(dim_info, args, compiled):
+    """MADDPG with a replay buffer filled with random experience"""
+    maddpg = MADDPG(dim_info, args.buffer_size, args.batch_size, 0.01, 0.01, tempfile.mkdtemp(), compiled=compiled)
+    n, agent_num = args.buffer_size, len(dim_info)
+    obs_dim = sum(obs_dim for obs_dim, _ in dim_info.values())
+    act_dim = np.array([act_dim for _, act_dim in dim_info.values()])
+    maddpg.add(np.random.randn(n, obs_dim), np.random.randint(act_dim, size=(n, agent_num)),
+               np.random.randn(n, agent_num), np.random.randn(n, obs_dim), np.zeros((n, agent_num)))
+    return maddpg
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('env_name', type=str, nargs='?', default='simple_tag_v3', help='name of the env')
+    parser.add_argument('--batch_sizes', type=int, nargs='+', default=[64, 256, 1024], help='batch-size of replay buffer')
+    parser.add_argument('--buffer_size', type=int, default=int(1e5), help='number of transitions in the buffer')
+    parser.add_argument('--repeat', type=int, default=50, help='learn steps measured for each batch size')
+    args = parser.parse_args()
+
+    torch.set_num_threads(1)
+    _, dim_info = get_env(args.env_name)
+    # cost of a learn step (in milliseconds) in eager mode and with `--compile`,
+    # the time of the first learn steps, which compile the graphs, is reported separately
+    print(f'{"batch size":>12}{"eager":>12}{"compiled":>12}{"speedup":>10}{"compile time":>15}')
+    for batch_size in args.batch_sizes:
+        args.batch_size = batch_size
+        costs = []
+        for compiled in (False, True):
+            maddpg = make_maddpg(dim_info, args, compiled)
+            start = time.perf_counter()
+            for _ in range(3):  # warm up
+                maddpg.learn(batch_size, 0.95)
+            warm_up = time.perf_counter() - start
+            costs.append(timeit.timeit(lambda: maddpg.learn(batch_size, 0.95), number=args.repeat) / args.repeat)
+        eager, compiled = costs
+        print(f'{batch_size:>12}{eager * 1e3:>10.2f}ms{compiled * 1e3:>10.2f}ms{eager / compiled:>9.2f}x'
+              f'{warm_up:>14.1f}s')
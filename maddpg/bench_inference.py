@@ -0,0 +1,69 @@
+import argparse
+import functools
+import timeit
+
+import torch
+
+from Agent import Agent
+from bench_learn import make_maddpg
+from Ensemble import CriticEnsemble
+from MADDPG import MADDPG
+
+# the modes the target networks run in: recording a graph which is detached afterwards, no grad, inference mode
+MODES = {'graph': torch.enable_grad, 'no_grad': torch.no_grad, 'inference_mode': torch.inference_mode}
+
+
+def use_mode(maddpg, mode):
+    """run the target networks of `maddpg` in `mode` instead of `Compiled.inference`"""
+    def wrap(fn, obj):
+        fn = functools.partial(fn.__wrapped__, obj)
+
+        def wrapped(*args, **kwargs):
+            with MODES[mode]():
+                output = fn(*args, **kwargs)
+            return output.detach()
+        return wrapped
+
+    maddpg.target_actions = wrap(MADDPG.target_actions, maddpg)
+    maddpg.critic_ensemble.target_value = wrap(CriticEnsemble.target_value, maddpg.critic_ensemble)
+    for _, agent in maddpg.roles:
+        agent.target_action = wrap(Agent.target_action, agent)
+
+
+def saved_tensors(fn):
+    """number and size (in MB) of the tensors saved for backward by `fn`"""
+    num, size = 0, 0
+
+    def pack(x):
+        nonlocal num, size
+        num += 1
+        size += x.numel() * x.element_size() / 2 ** 20
+        return x
+
+    with torch.autograd.graph.saved_tensors_hooks(pack, lambda x: x):
+        fn()
+    return num, size
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--batch_size', type=int, default=1024, help='batch-size of replay buffer')
+    parser.add_argument('--buffer_size', type=int, default=int(1e5), help='number of transitions in the buffer')
+    parser.add_argument('--obs_dim', type=int, default=16, help='obs dim of each agent')
+    parser.add_argument('--act_dim', type=int, default=5, help='action dim of each agent')
+    parser.add_argument('--repeat', type=int, default=50, help='learn steps measured for each mode')
+    parser.add_argument('--agent_nums', type=int, nargs='+', default=[4, 16], help='number of agents')
+    args = parser.parse_args()
+
+    torch.set_num_threads(1)
+    # cost of a learn step (in milliseconds) and the tensors saved for backward in it,
+    # with the target networks in each mode, the saved tensors of the graph mode are only freed by the detach
+    print(f'{"agents":>8}{"mode":>16}{"learn step":>14}{"saved tensors":>16}{"saved size":>13}')
+    for agent_num in args.agent_nums:
+        for mode in MODES:
+            maddpg = make_maddpg(agent_num, args)
+            use_mode(maddpg, mode)
+            maddpg.learn(args.batch_size, 0.95)  # warm up
+            num, size = saved_tensors(lambda: maddpg.learn(args.batch_size, 0.95))
+            cost = timeit.timeit(lambda: maddpg.learn(args.batch_size, 0.95), number=args.repeat) / args.repeat
+            print(f'{agent_num:>8}{mode:>16}{cost * 1e3:>12.2f}ms{num:>16}{size:>11.1f}MB')
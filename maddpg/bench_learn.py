@@ -0,0 +1,43 @@
+import argparse
+import tempfile
+import timeit
+
+import numpy as np
+import torch
+
+from MADDPG import MADDPG
+
+
+def make_maddpg(agent_num, args, **kwargs):
+    """MADDPG of `agent_num` agents of the same dims (and role), with a replay buffer filled with random experience"""
+    dim_info = {f'agent_{i}': [args.obs_dim, args.act_dim] for i in range(agent_num)}
+    maddpg = MADDPG(dim_info, args.buffer_size, args.batch_size, 0.01, 0.01, tempfile.mkdtemp(), **kwargs)
+    n, obs_dim = args.buffer_size, args.obs_dim * agent_num
+    maddpg.add(np.random.randn(n, obs_dim), np.random.randint(args.act_dim, size=(n, agent_num)),
+               np.random.randn(n, agent_num), np.random.randn(n, obs_dim), np.zeros((n, agent_num)))
+    return maddpg
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--batch_size', type=int, default=1024, help='batch-size of replay buffer')
+    parser.add_argument('--buffer_size', type=int, default=int(1e5), help='number of transitions in the buffer')
+    parser.add_argument('--obs_dim', type=int, default=16, help='obs dim of each agent')
+    parser.add_argument('--act_dim', type=int, default=5, help='action dim of each agent')
+    parser.add_argument('--repeat', type=int, default=20, help='learn steps measured for each agent count')
+    parser.add_argument('--agent_nums', type=int, nargs='+', default=[2, 4, 8, 16], help='number of agents')
+    args = parser.parse_args()
+
+    torch.set_num_threads(1)
+    # cost of a learn step (in milliseconds) as the number of agents grows
+    # independent samples, a shared batch, and a shared batch with all the agents sharing one network (one role)
+    print(f'{"agents":>8}{"independent":>14}{"shared":>12}{"speedup":>10}{"share_params":>15}{"speedup":>10}')
+    for agent_num in args.agent_nums:
+        costs = []
+        for kwargs in ({'independent_samples': True}, {}, {'share_params': True, 'agent_id_input': True}):
+            maddpg = make_maddpg(agent_num, args, **kwargs)
+            maddpg.learn(args.batch_size, 0.95)  # warm up
+            costs.append(timeit.timeit(lambda: maddpg.learn(args.batch_size, 0.95), number=args.repeat) / args.repeat)
+        independent, shared, share_params = costs
+        print(f'{agent_num:>8}{independent * 1e3:>12.1f}ms{shared * 1e3:>10.1f}ms{independent / shared:>9.2f}x'
+              f'{share_params * 1e3:>13.1f}ms{independent / share_params:>9.2f}x')
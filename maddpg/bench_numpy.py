@@ -0,0 +1,68 @@
+import argparse
+import os
+import tempfile
+import timeit
+
+import numpy as np
+import torch
+
+from MADDPG import MADDPG
+from main import get_env
+from NumpyPolicy import NumpyPolicy, export
+
+
+def greedy_action(maddpg, obs):
+    """the action of largest logit in torch, as `NumpyPolicy.action`"""
+    o = torch.from_numpy(np.atleast_2d(obs)).float()
+    action = torch.empty(o.shape[0], len(maddpg.agents), dtype=torch.long)
+    with torch.no_grad():
+        for index, logits in maddpg.actor_ensemble._forward(o):
+            action[:, index] = logits.argmax(dim=-1).T
+    return action.numpy() if obs.ndim > 1 else action.numpy()[0]
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('env_name', type=str, nargs='?', default='simple_tag_v3', help='name of the env')
+    parser.add_argument('--repeat', type=int, default=2000, help='action selections measured for each batch size')
+    parser.add_argument('--num_envs', type=int, nargs='+', default=[1, 16, 256],
+                        help='number of env copies the actions are selected for at a time')
+    args = parser.parse_args()
+
+    torch.set_num_threads(1)
+    _, dim_info = get_env(args.env_name)
+    res_dir = tempfile.mkdtemp()
+    maddpg = MADDPG(dim_info, 0, 0, 0.01, 0.01, res_dir)
+    for agent in maddpg.agents.values():  # actors as if trained
+        for p in agent.actor.parameters():
+            p.data.add_(torch.randn_like(p) * 0.1)
+    maddpg.save({})
+    export(os.path.join(res_dir, 'model.pt'), os.path.join(res_dir, 'model.npz'))
+    export(os.path.join(res_dir, 'model.pt'), os.path.join(res_dir, 'model_int8.npz'), int8=True)
+    policy = NumpyPolicy.load(os.path.join(res_dir, 'model.npz'))
+    int8_policy = NumpyPolicy.load(os.path.join(res_dir, 'model_int8.npz'))
+
+    # the logits and the action of the largest one are those of the actors in torch
+    obs = np.random.randn(4096, maddpg.buffer.obs_slices[-1].stop).astype(np.float32)
+    logits_error = 0
+    with torch.no_grad():
+        for (index, logits), (_, np_logits) in zip(maddpg.actor_ensemble._forward(torch.from_numpy(obs)),
+                                                   policy._forward(obs)):
+            logits_error = max(logits_error, np.abs(logits.numpy() - np_logits).max())
+    mismatch = np.mean(greedy_action(maddpg, obs) != policy.action(obs))
+    print(f'max logits error: {logits_error:.3g}, actions mismatch: {mismatch:.3%}')
+    assert logits_error < 1e-4 and mismatch < 1e-3, 'the numpy actors diverge from the torch actors'
+    print(f'parameters of the actors: {policy.nbytes / 1024:.1f}KB, '
+          f'{int8_policy.nbytes / 1024:.1f}KB with int8 weights, int8 actions mismatch: {np.mean(policy.action(obs) != int8_policy.action(obs)):.3%}')
+
+    # latency of selecting the actions of all the agents for one step (in microseconds)
+    print(f'{"num_envs":>10}{"select_action":>16}{"torch greedy":>15}{"numpy":>12}{"speedup":>10}{"numpy int8":>13}')
+    for num_envs in args.num_envs:
+        obs = np.random.randn(num_envs, maddpg.buffer.obs_slices[-1].stop).astype(np.float32)
+        if num_envs == 1:
+            obs = obs[0]  # a single env, as in evaluate.py
+        costs = [timeit.timeit(lambda: fn(obs), number=args.repeat) / args.repeat * 1e6
+                 for fn in (maddpg.select_action, lambda o: greedy_action(maddpg, o),
+                            lambda o: policy.action(o, explore=True), lambda o: int8_policy.action(o, explore=True))]
+        print(f'{num_envs:>10}{costs[0]:>14.1f}us{costs[1]:>13.1f}us{costs[2]:>10.1f}us{costs[0] / costs[2]:>9.2f}x'
+              f'{costs[3]:>11.1f}us')
@@ -0,0 +1,37 @@
+import argparse
+import timeit
+
+import numpy as np
+
+from Sampler import SAMPLERS
+
+
+def choice_without_replacement(total_num, batch_size):
+    """the sampling used before the sampler subsystem, as a baseline"""
+    return np.random.choice(total_num, size=batch_size, replace=False)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--batch_size', type=int, default=1024, help='batch-size of replay buffer')
+    parser.add_argument('--repeat', type=int, default=200, help='sample calls measured for each buffer size')
+    parser.add_argument('--sizes', type=int, nargs='+', default=[int(1e4), int(1e5), int(3e5), int(1e6)],
+                        help='number of transitions in the buffer')
+    args = parser.parse_args()
+
+    names = ['np.random.choice'] + list(SAMPLERS)
+
+    # cost of a single sample call (in microseconds) as the buffer fills
+    print(f'{"buffer size":>12}' + ''.join(f'{name:>18}' for name in names))
+    for total_num in args.sizes:
+        samplers = [choice_without_replacement]
+        for sampler_cls in SAMPLERS.values():
+            sampler = sampler_cls(total_num)
+            sampler.add(np.arange(total_num))  # as if all the transitions were just added to the buffer
+            samplers.append(sampler.sample)
+
+        message = f'{total_num:>12}'
+        for sample in samplers:
+            cost = timeit.timeit(lambda: sample(total_num, args.batch_size), number=args.repeat) / args.repeat
+            message += f'{cost * 1e6:>16.1f}us'
+        print(message)
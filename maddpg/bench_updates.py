@@ -0,0 +1,30 @@
+import argparse
+import timeit
+
+import torch
+
+from bench_learn import make_maddpg
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--batch_size', type=int, default=1024, help='batch-size of replay buffer')
+    parser.add_argument('--buffer_size', type=int, default=int(1e5), help='number of transitions in the buffer')
+    parser.add_argument('--obs_dim', type=int, default=16, help='obs dim of each agent')
+    parser.add_argument('--act_dim', type=int, default=5, help='action dim of each agent')
+    parser.add_argument('--agent_num', type=int, default=4, help='number of agents')
+    parser.add_argument('--repeat', type=int, default=64, help='updates measured for each value')
+    parser.add_argument('--updates_per_learn', type=int, nargs='+', default=[1, 4, 16], help='updates per learn step')
+    args = parser.parse_args()
+
+    torch.set_num_threads(1)
+    # cost of an update (in milliseconds) when the batches of `updates_per_learn` updates are gathered at once,
+    # and the time of the learner spent gathering them
+    print(f'{"updates":>8}{"update":>12}{"gather":>12}')
+    for updates_per_learn in args.updates_per_learn:
+        maddpg = make_maddpg(args.agent_num, args, updates_per_learn=updates_per_learn)
+        maddpg.learn(args.batch_size, 0.95)  # warm up
+        maddpg.batches.clear()
+        maddpg.sample_wait = 0
+        cost = timeit.timeit(lambda: maddpg.learn(args.batch_size, 0.95), number=args.repeat) / args.repeat
+        print(f'{updates_per_learn:>8}{cost * 1e3:>10.2f}ms{maddpg.sample_wait / args.repeat * 1e3:>10.3f}ms')
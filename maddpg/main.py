@@ -1,35 +1,21 @@
 import argparse
+import functools
 import os
 import matplotlib.pyplot as plt
 import numpy as np
-from pettingzoo.mpe import simple_adversary_v3, simple_spread_v3, simple_tag_v3, simple_v3, simple_world_comm_v3
 
+from Env import get_env
 from MADDPG import MADDPG
+from Rollout import RolloutPool
+from SimpleTag import SimpleTag
+from VectorEnv import SubprocVectorEnv, VectorEnv
 
 
-def get_env(env_name, ep_len=25, mode= None):
-    """create environment and get observation and action dimension of each agent in this environment"""
-    new_env = None
-    if env_name == 'simple_adversary_v3':
-        new_env = simple_adversary_v3.parallel_env(max_cycles=ep_len, render_mode= mode)
-    if env_name == 'simple_spread_v3':
-        new_env = simple_spread_v3.parallel_env(max_cycles=ep_len, render_mode= mode)
-    if env_name == 'simple_tag_v3':
-        new_env = simple_tag_v3.parallel_env(max_cycles=ep_len, render_mode= mode)
-    if env_name == "simple_v3":
-        new_env = simple_v3.parallel_env(max_cycles=ep_len, render_mode= mode)
-    if env_name == "simple_world_comm_v3":
-        new_env = simple_world_comm_v3.parallel_env(max_cycles=ep_len, render_mode= mode)
-
-
-    new_env.reset()
-    _dim_info = {}
-    for agent_id in new_env.agents:
-        _dim_info[agent_id] = []  # [obs_dim, act_dim]
-        _dim_info[agent_id].append(new_env.observation_space(agent_id).shape[0])
-        _dim_info[agent_id].append(new_env.action_space(agent_id).n)
-
-    return new_env, _dim_info
+def get_vector_env(env_name, ep_len=25, num_envs=1, numpy_env=False):
+    """create `num_envs` copies of the environment stepped together, simulated in numpy if `numpy_env`"""
+    if numpy_env:
+        return SimpleTag(num_envs, ep_len)
+    return VectorEnv([get_env(env_name, ep_len)[0] for _ in range(num_envs)])
 
 
 if __name__ == '__main__':
@@ -44,12 +30,72 @@ if __name__ == '__main__':
     parser.add_argument('--random_steps', type=int, default=5e4,
                         help='random steps before the agent start to learn')
     parser.add_argument('--tau', type=float, default=0.02, help='soft update parameter')
+    parser.add_argument('--hard_update_interval', type=int, default=0,
+                        help='learn steps between copying the networks to the target networks, '
+                             'instead of the soft update after each learn step, 0 for the soft update')
+    parser.add_argument('--updates_per_learn', type=int, default=1,
+                        help='updates of the networks in each learn step, back to back on the minibatches of '
+                             'one gather from the buffer, more updates per environment step')
+    parser.add_argument('--soft_update_once', action='store_true',
+                        help='with --updates_per_learn, soft update the target networks once after the updates '
+                             'of each learn step, instead of after each update')
+    parser.add_argument('--action_log_interval', type=int, default=1,
+                        help='steps between recording the actions selected for the env by the actors (also those '
+                             'of the rollout processes) to actions.bin in the result folder, written with their '
+                             'histogram in maddpg.log by a background thread, 0 not to record them')
     parser.add_argument('--gamma', type=float, default=0.95, help='discount factor')
     parser.add_argument('--buffer_capacity', type=int, default=int(1e6), help='capacity of replay buffer')
     parser.add_argument('--batch_size', type=int, default=1024, help='batch-size of replay buffer')
     parser.add_argument('--actor_lr', type=float, default=0.01, help='learning rate of actor')
     parser.add_argument('--critic_lr', type=float, default=0.01, help='learning rate of critic')
+    parser.add_argument('--sampler', type=str, default='unique',
+                        choices=['uniform', 'unique', 'stratified', 'prioritized'],
+                        help='how to sample the replay buffer: with replacement, without replacement, '
+                             'stratified or prioritized by TD error')
+    parser.add_argument('--per_alpha', type=float, default=0.6, help='priority exponent of prioritized replay')
+    parser.add_argument('--per_beta', type=float, default=0.4,
+                        help='importance-sampling exponent of prioritized replay')
+    parser.add_argument('--dedup_obs', action='store_true',
+                        help='store each observation once in the replay buffer, rebuild next_obs when sampling')
+    parser.add_argument('--obs_dtype', type=str, default='float32', choices=['float32', 'float16', 'int8'],
+                        help='dtype of the observations stored in the replay buffer')
+    parser.add_argument('--prefetch', type=int, default=0,
+                        help='number of batches gathered ahead in a background thread, 0 to sample synchronously')
+    parser.add_argument('--independent_samples', action='store_true',
+                        help='sample a batch for each update of a learn step, '
+                             'instead of sharing one batch and its target actions')
+    parser.add_argument('--compile', action='store_true',
+                        help='compile the computation of the learn step with torch.compile, '
+                             'run it in eager mode if compilation is unavailable')
+    parser.add_argument('--share_params', action='store_true',
+                        help='the agents of a role (e.g. adversary_0, adversary_1, ...) share one actor and one critic')
+    parser.add_argument('--agent_id_input', action='store_true',
+                        help='with --share_params, the networks of a role also take the one-hot id of the agent')
+    parser.add_argument('--memmap', action='store_true',
+                        help='store the replay buffer in memory-mapped files in the result folder')
+    parser.add_argument('--resume_buffer', type=str, default=None,
+                        help='result folder of a previous run with --memmap, continue with the replay buffer saved there')
+    parser.add_argument('--num_envs', type=int, default=1,
+                        help='number of env copies stepped together, the actions of all the copies are selected in a batch')
+    parser.add_argument('--subproc', action='store_true',
+                        help='step each env copy in a worker process, exchange the experience through shared memory')
+    parser.add_argument('--numpy_env', action='store_true',
+                        help='simulate all the --num_envs copies of simple_tag_v3 in a batch in numpy')
+    parser.add_argument('--num_actors', type=int, default=0,
+                        help='number of rollout processes, each steps --num_envs copies of the env, and the learner '
+                             'trains continuously on the experience they stream, 0 to alternate interaction and learning')
+    parser.add_argument('--publish_interval', type=int, default=100,
+                        help='learn steps between publishing the actors of the learner to the rollout processes')
     args = parser.parse_args()
+    if args.numpy_env and args.env_name != 'simple_tag_v3':
+        parser.error('--numpy_env only simulates simple_tag_v3')
+    if args.numpy_env and args.subproc:
+        parser.error('--numpy_env steps all the copies in a batch, --subproc is not needed')
+    if args.num_actors and args.subproc:
+        parser.error('--num_actors steps the env copies in the rollout processes, --subproc is not supported')
+    if args.num_actors > 1 and args.dedup_obs:
+        parser.error('--dedup_obs needs the steps of each env copy in a stride, '
+                     'the steps of several rollout processes are interleaved')
 
     # create folder to save result
     env_dir = os.path.join('./results', args.env_name)
@@ -59,51 +105,120 @@ if __name__ == '__main__':
     result_dir = os.path.join(env_dir, f'{total_files + 1}')
     os.makedirs(result_dir)
 
-    env, dim_info = get_env(args.env_name, args.episode_length)
+    buffer_dir = None
+    if args.resume_buffer is not None:
+        buffer_dir = os.path.join(env_dir, args.resume_buffer, 'buffer')
+        assert os.path.exists(buffer_dir)
+    elif args.memmap:
+        buffer_dir = os.path.join(result_dir, 'buffer')
+
+    # prioritized replay is the only sampler with parameters
+    sampler_kwargs = {'alpha': args.per_alpha, 'beta': args.per_beta} if args.sampler == 'prioritized' else {}
+
+    env_fn = functools.partial(get_env, args.env_name, args.episode_length)
+    vector_env_fn = functools.partial(get_vector_env, args.env_name, args.episode_length, args.num_envs,
+                                      args.numpy_env)
+    _, dim_info = env_fn()
     maddpg = MADDPG(dim_info, args.buffer_capacity, args.batch_size, args.actor_lr, args.critic_lr,
-                    result_dir)
-
-    step = 0  # global step counter
-    agent_num = env.num_agents
-    # reward of each episode of each agent
-    episode_rewards = {agent_id: np.zeros(args.episode_num) for agent_id in env.agents}
-    for episode in range(args.episode_num):
-        obs, info = env.reset()
-        agent_reward = {agent_id: 0 for agent_id in env.agents}  # agent reward of the current episode
-        while env.agents:  # interact with the env for an episode
-            step += 1
+                    result_dir, args.sampler, buffer_dir, args.dedup_obs, args.obs_dtype,
+                    args.prefetch, args.independent_samples, args.compile, args.updates_per_learn,
+                    args.action_log_interval, args.share_params, args.agent_id_input, **sampler_kwargs)
+    # the experience in a resumed buffer counts as warm-up
+    args.random_steps = max(0, args.random_steps - len(maddpg.buffer))
+
+    step = 0  # global step counter, each step of the `VectorEnv` counts as `num_envs` steps
+    episode = 0  # number of finished episodes
+    # reward of each episode of each agent, the agents are in the order of `dim_info`
+    episode_rewards = np.zeros((args.episode_num, len(dim_info)))
+
+
+    def print_episode(episode):
+        """print the reward of each agent of the `episode`-th episode"""
+        message = f'episode {episode}, '
+        sum_reward = 0
+        for agent_id, r in zip(dim_info, episode_rewards[episode - 1]):
+            message += f'{agent_id}: {r:>4f}; '
+            sum_reward += r
+        message += f'sum reward: {sum_reward}; '
+        message += f'learner waiting for sampler: {maddpg.sample_wait:.2f}s'
+        print(message)
+
+
+    def learn(learn_step):
+        """the `learn_step`-th learn step, `--updates_per_learn` updates and the update of the target networks"""
+        for k in range(args.updates_per_learn):
+            maddpg.learn(args.batch_size, args.gamma)
+            if not args.hard_update_interval and (not args.soft_update_once or k == args.updates_per_learn - 1):
+                maddpg.update_target(args.tau)
+        if args.hard_update_interval and learn_step % args.hard_update_interval == 0:
+            maddpg.update_target(1)
+
+
+    learn_step = 0  # number of learn steps
+    if args.num_actors:  # the rollout processes collect the experience while the learner trains
+        pool = RolloutPool(vector_env_fn, maddpg.actors(), maddpg.buffer.obs_slices,
+                           args.num_actors, args.random_steps // args.num_actors)
+        while episode < args.episode_num:
+            # take the experience streamed so far, wait for it if there is nothing to learn from yet
+            for obs, action, reward, next_obs, done, finished_rewards in pool.get(block=step < args.random_steps):
+                maddpg.add(obs, action, reward, next_obs, done)
+                step += args.num_envs
+                if step >= args.random_steps:  # the actions of the actors, as `select_action` records them
+                    maddpg.record_actions(action)
+                for agent_reward in finished_rewards:  # record reward
+                    if episode == args.episode_num:
+                        break
+                    episode_rewards[episode] = agent_reward
+                    episode += 1
+                    if episode % 100 == 0:  # print info every 100 episodes
+                        print_episode(episode)
+
+            if step >= args.random_steps:
+                learn_step += 1
+                learn(learn_step)
+                if learn_step % args.publish_interval == 0:
+                    pool.publish(maddpg.actors())
+        pool.close()
+    else:
+        if args.subproc:
+            env = SubprocVectorEnv(env_fn, args.num_envs, dim_info)
+        else:
+            env = vector_env_fn()
+        # agent reward of the current episode of each env copy
+        agent_reward = np.zeros((env.num_envs, len(dim_info)))
+        obs = env.reset()
+        while episode < args.episode_num:
+            step += env.num_envs
             if step < args.random_steps:
-                action = {agent_id: env.action_space(agent_id).sample() for agent_id in env.agents}
+                action = env.sample_action()
             else:
                 action = maddpg.select_action(obs)
 
-            next_obs, reward, done, truncated,info = env.step(action)
-            # env.render()
+            next_obs, reward, done, truncated, finished = env.step(action)
 
             maddpg.add(obs, action, reward, next_obs, done)
 
-            for agent_id, r in reward.items():  # update reward
-                agent_reward[agent_id] += r
+            agent_reward += reward  # update reward
 
-            if step >= args.random_steps and step % args.learn_interval == 0:  # learn every few steps
-                maddpg.learn(args.batch_size, args.gamma)
-                maddpg.update_target(args.tau)
+            if step >= args.random_steps:  # learn every few steps, as often as stepping the copies one by one
+                for _ in range(step // args.learn_interval - (step - env.num_envs) // args.learn_interval):
+                    learn_step += 1
+                    learn(learn_step)
 
-            obs = next_obs
+            obs = env.obs  # the copies that finished are reset
 
-        # episode finishes
-        for agent_id, r in agent_reward.items():  # record reward
-            episode_rewards[agent_id][episode] = r
+            for i in np.flatnonzero(finished):  # episode finishes
+                if episode == args.episode_num:
+                    break
+                episode_rewards[episode] = agent_reward[i]  # record reward
+                agent_reward[i] = 0
+                episode += 1
 
-        if (episode + 1) % 100 == 0:  # print info every 100 episodes
-            message = f'episode {episode + 1}, '
-            sum_reward = 0
-            for agent_id, r in agent_reward.items():  # record reward
-                message += f'{agent_id}: {r:>4f}; '
-                sum_reward += r
-            message += f'sum reward: {sum_reward}'
-            print(message)
+                if episode % 100 == 0:  # print info every 100 episodes
+                    print_episode(episode)
+        env.close()
 
+    episode_rewards = dict(zip(dim_info, episode_rewards.T))
     maddpg.save(episode_rewards)  # save model
     
 
@@ -0,0 +1,61 @@
+import argparse
+import time
+
+import numpy as np
+
+from main import get_env
+from SimpleTag import SimpleTag
+from VectorEnv import VectorEnv
+
+
+def load_state(sim, envs):
+    """copy the state of the worlds of pettingzoo `envs` to the simulator"""
+    for b, env in enumerate(envs):
+        world = env.unwrapped.world
+        sim.pos[b] = [entity.state.p_pos for entity in world.agents + world.landmarks]
+        sim.vel[b] = [agent.state.p_vel for agent in world.agents]
+
+
+def throughput(env, step_num):
+    """env steps per second (counting each world), with random actions"""
+    env.reset()
+    start = time.perf_counter()
+    for _ in range(step_num // env.num_envs):
+        env.step(env.sample_action())
+    return step_num // env.num_envs * env.num_envs / (time.perf_counter() - start)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--episode_length', type=int, default=25, help='steps per episode')
+    parser.add_argument('--num_envs', type=int, default=16, help='number of worlds compared at a time')
+    parser.add_argument('--episode_num', type=int, default=20, help='episodes of each world compared')
+    parser.add_argument('--step_num', type=int, default=20000, help='steps measured for the throughput')
+    args = parser.parse_args()
+
+    # step the worlds of pettingzoo and of the simulator from the same state with the same actions
+    env = VectorEnv([get_env('simple_tag_v3', args.episode_length)[0] for _ in range(args.num_envs)])
+    _, dim_info = get_env('simple_tag_v3', args.episode_length)
+    sim = SimpleTag(args.num_envs, args.episode_length)
+    assert sim.dim_info == dim_info, f'{sim.dim_info} != {dim_info}'
+
+    obs_error, reward_error = 0, 0
+    for episode in range(args.episode_num):
+        obs = env.reset()
+        sim.reset()
+        load_state(sim, env.envs)
+        obs_error = max(obs_error, np.abs(sim.observe() - obs).max())
+        finished = np.zeros(args.num_envs, dtype=bool)
+        while not finished.any():
+            action = env.sample_action()
+            next_obs, reward, _, truncated, finished = env.step(action)
+            sim_next_obs, sim_reward, _, sim_truncated, sim_finished = sim.step(action)
+            assert np.array_equal(finished, sim_finished) and np.array_equal(truncated, sim_truncated)
+            obs_error = max(obs_error, np.abs(sim_next_obs - next_obs).max())
+            reward_error = max(reward_error, np.abs(sim_reward - reward).max())
+    print(f'max obs error: {obs_error:.3g}, max reward error: {reward_error:.3g}')
+    assert obs_error < 1e-5 and reward_error < 1e-5, 'the simulator diverges from simple_tag_v3'
+
+    print(f'pettingzoo: {throughput(env, args.step_num):.0f} steps/s')
+    for num_envs in (args.num_envs, 256, 4096):
+        print(f'numpy, {num_envs} worlds: {throughput(SimpleTag(num_envs, args.episode_length), args.step_num * 10):.0f} steps/s')
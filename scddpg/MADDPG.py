@@ -1,15 +1,21 @@
 import logging
 import os
 import pickle
+import threading
+import time
 from Agent import MLPNetwork
 import numpy as np
 import torch
 import torch.nn.functional as F
 from copy import deepcopy
 from Agent import Agent
-from Buffer import Buffer
+from Buffer import Buffer, MemmapBuffer
+from Compiled import Compiled, inference
+from Ensemble import ActorEnsemble
+from Prefetcher import Prefetcher
+from Sampler import get_sampler
+from Telemetry import ActionTelemetry
 from torch.optim import Adam
-from typing import List
 from torch import nn, Tensor
 
 def setup_logger(filename):
@@ -27,10 +33,19 @@ def setup_logger(filename):
     return logger
 
 
+def weighted_mse_loss(value, target, weights):
+    """mse loss scaled by the importance-sampling `weights` of each sample, plain mse loss if `weights` is None"""
+    if weights is None:
+        return F.mse_loss(value, target, reduction='mean')
+    return (weights * (value - target) ** 2).mean()
+
+
 class MADDPG:
     """A MADDPG(Multi Agent Deep Deterministic Policy Gradient) agent"""
 
-    def __init__(self, dim_info, capacity, batch_size, actor_lr, critic_lr, res_dir):
+    def __init__(self, dim_info, capacity, batch_size, actor_lr, critic_lr, res_dir, sampler='unique', buffer_dir=None,
+                 dedup_obs=False, obs_dtype='float32', prefetch=0, independent_samples=False, compiled=False,
+                 updates_per_learn=1, action_log_interval=1, **sampler_kwargs):
         # sum all the dims of each agent to get input dim for critic
         global_obs_act_dim = sum(sum(val) for val in dim_info.values())
 
@@ -39,63 +54,126 @@ class MADDPG:
         self.target_critic = deepcopy(self.critic)
         self.critic_optimizer = Adam(self.critic.parameters(), lr=critic_lr)
 
-        # create Agent(actor-critic) and replay buffer for each agent
+        # create Agent(actor-critic) for each agent
         self.agents = {}
-        self.buffers = {}
         for agent_id, (obs_dim, act_dim) in dim_info.items():
             self.agents[agent_id] = Agent(obs_dim, act_dim, global_obs_act_dim, actor_lr, critic_lr, self.critic, self.target_critic)
-            self.buffers[agent_id] = Buffer(capacity, obs_dim, act_dim, 'cpu')
+        # the parameters of the networks and of their target networks, in the same order, see `update_target`
+        networks = [(agent.actor, agent.target_actor) for agent in self.agents.values()]
+        networks += [(self.critic, self.target_critic)]
+        self.network_params = [p for network, _ in networks for p in network.parameters()]
+        self.target_params = [p for _, target_network in networks for p in target_network.parameters()]
+        # a single replay buffer stores the experience of all the agents,
+        # it is kept in memory-mapped files under `buffer_dir` if specified
+        if buffer_dir is None:
+            self.buffer = Buffer(capacity, dim_info, 'cpu', dedup_obs, obs_dtype)
+        else:
+            self.buffer = MemmapBuffer(capacity, dim_info, 'cpu', buffer_dir, dedup_obs, obs_dtype)
+        # decide which transitions are sampled from the buffer, the experience of a resumed buffer counts as new
+        self.sampler = get_sampler(sampler, capacity, **sampler_kwargs)
+        self.sampler.add(np.arange(len(self.buffer)))
+        # select the actions of all the agents in one pass, the actors of the same shape are evaluated together
+        self.actor_ensemble = ActorEnsemble([agent.actor for agent in self.agents.values()], self.buffer.obs_slices)
+        # if `prefetch` > 0, batches are gathered into `prefetch` slots ahead of time in a background thread,
+        # which is started at the first `sample`, `lock` guards the buffer and the sampler shared with it
+        self.prefetch = prefetch
+        self.prefetcher = None
+        self.lock = threading.Lock()
+        self.sample_wait = 0  # total time the learner waits for sampled batches
+        # by default all the updates of a learn step share one batch and its target actions,
+        # if `independent_samples`, each update samples its own batch
+        self.independent_samples = independent_samples
+        # a learn call runs `updates_per_learn` updates, whose batches are gathered at once, see `sample`
+        self.updates_per_learn = updates_per_learn
+        self.batches = []  # the minibatches gathered and not taken yet
+        # if `compiled`, the computation of the learn step is compiled into graphs, see `Compiled`
+        if compiled:
+            self.target_actions = Compiled(self.target_actions)
+            self.critic_loss = Compiled(self.critic_loss)
+            self.actor_loss = Compiled(self.actor_loss)
         self.dim_info = dim_info
 
         self.batch_size = batch_size
         self.res_dir = res_dir  # directory to save the training result
         self.logger = setup_logger(os.path.join(res_dir, 'maddpg.log'))
+        # the actions of every `action_log_interval`-th step are recorded to `res_dir`, see `ActionTelemetry`,
+        # which is started at the first `select_action`, 0 not to record them
+        self.action_log_interval = action_log_interval
+        self.telemetry = None
 
     def add(self, obs, action, reward, next_obs, done):
-        # NOTE that the experience is a dict with agent name as its key
-        for agent_id in obs.keys():
-            o = obs[agent_id]
-
-            a = action[agent_id]
-            if isinstance(a, int):
-                # the action from env.action_space.sample() is int, we have to convert it to onehot
-                a = np.eye(self.dim_info[agent_id][1])[a]
-
-            r = reward[agent_id]
-            next_o = next_obs[agent_id]
-            d = done[agent_id]
-            self.buffers[agent_id].add(o, a, r, next_o, d)
+        # NOTE that the experience is in the joint layout of the agents, stacked over env copies (see `VectorEnv`),
+        # the action is an int of each agent, it is stored as it is and only converted to onehot when sampled
+        with self.lock:
+            index = self.buffer.add(obs, action, reward, next_obs, done)
+            self.sampler.add(index)
+
+    def gather(self, batch_size):
+        """gather `batch_size` transitions from the shared buffer: (obs, action, reward, next_obs, done), indices,
+        and their importance-sampling weights"""
+        if self.prefetch:
+            if self.prefetcher is None:
+                self.prefetcher = Prefetcher(self.buffer, self.sampler, batch_size, self.lock, self.prefetch)
+            batch, indices, weights = self.prefetcher.get()
+            self.sample_wait = self.prefetcher.wait_time
+        else:
+            start = time.perf_counter()
+            total_num = len(self.buffer)
+            indices = self.sampler.sample(total_num, batch_size)
+            weights = self.sampler.weights(total_num, indices)
+            batch = self.buffer.sample(indices)
+            self.sample_wait += time.perf_counter() - start
+        return batch, indices, weights
 
     def sample(self, batch_size):
-        """sample experience from all the agents' buffers, and collect data for network input"""
-        # get the total num of transitions, these buffers should have same number of transitions
-        total_num = len(self.buffers['agent_0'])
-        indices = np.random.choice(total_num, size=batch_size, replace=False)
-
+        """sample experience from the shared buffer, and collect data for network input"""
         # NOTE that in MADDPG, we need the obs and actions of all agents
         # but only the reward and done of the current agent is needed in the calculation
-        obs, act, reward, next_obs, done, next_act = {}, {}, {}, {}, {}, {}
-        for agent_id, buffer in self.buffers.items():
-            o, a, r, n_o, d = buffer.sample(indices)
-            obs[agent_id] = o
-            act[agent_id] = a
-            reward[agent_id] = r
-            next_obs[agent_id] = n_o
-            done[agent_id] = d
-            # calculate next_action using target_network and next_state
-            next_act[agent_id] = self.agents[agent_id].target_action(n_o)
-
-        return obs, act, reward, next_obs, done, next_act
+        if not self.batches:
+            # the batches of `updates_per_learn` updates are gathered from the buffer at once and sliced into
+            # minibatches taken in turn, NOTE that a prefetched batch is in use until all its minibatches are taken
+            batch, indices, weights = self.gather(batch_size * self.updates_per_learn)
+            for k in reversed(range(self.updates_per_learn)):
+                s = slice(k * batch_size, (k + 1) * batch_size)
+                self.batches.append(([x[s] for x in batch], indices[s], None if weights is None else weights[s]))
+        (o, a, r, n_o, d), indices, weights = self.batches.pop()
+        if weights is not None:
+            weights = torch.from_numpy(weights).to(self.buffer.device)
+
+        # the batch is in the joint layout of the agents, e.g. obs is of size (batch_size, sum of obs_dim),
+        # the block of an agent is `self.buffer.obs_slices[i]`, reward is of size (batch_size, agent_num)
+        # calculate next_action using target_network and next_state
+        next_a = self.target_actions(n_o)
+
+        # `indices` and `weights` are needed for prioritized replay
+        return o, a, r, n_o, d, next_a, indices, weights
+
+    def replace_action(self, act, i, action):
+        """the joint action `act` with the block of the `i`-th agent replaced by `action`"""
+        s = self.buffer.act_slices[i]
+        return torch.cat((act[:, :s.start], action, act[:, s.stop:]), dim=1)
+
+    @inference
+    def target_actions(self, next_obs):
+        """the joint next action of all the agents by their target actors, given the joint next obs"""
+        return torch.cat([agent.target_action(next_obs[:, s])
+                          for agent, s in zip(self.agents.values(), self.buffer.obs_slices)], dim=1)
 
     def select_action(self, obs):
-        actions = {}
-        for agent, o in obs.items():
-            o = torch.from_numpy(o).unsqueeze(0).float()
-            a = self.agents[agent].action(o)  # torch.Size([1, action_size])
-            # NOTE that the output is a tensor, convert it to int before input to the environment
-            actions[agent] = a.squeeze(0).argmax().item()
-            self.logger.info(f'{agent} action: {actions[agent]}')
-        return actions
+        # the joint obs is either of a single env or stacked over env copies,
+        # the action is an int of each agent, of size (agent_num) or (num_envs, agent_num) accordingly
+        o = torch.from_numpy(np.atleast_2d(obs)).float()
+        actions = self.actor_ensemble.action(o).numpy()
+        self.record_actions(actions)
+        return actions if obs.ndim > 1 else actions[0]
+
+    def record_actions(self, actions):
+        """record the actions selected for the env, by `select_action` or by the rollout processes"""
+        if self.action_log_interval:
+            if self.telemetry is None:
+                self.telemetry = ActionTelemetry(os.path.join(self.res_dir, 'actions.bin'), self.dim_info,
+                                                 self.action_log_interval)
+            self.telemetry.record(actions)
 
     def update_critic(self, loss):
         self.critic_optimizer.zero_grad()
@@ -103,68 +181,73 @@ class MADDPG:
         torch.nn.utils.clip_grad_norm_(self.critic.parameters(), 0.5)
         self.critic_optimizer.step()
 
-    def critic_value(self, state_list: List[Tensor], act_list: List[Tensor]):
-        x = torch.cat(state_list + act_list, 1)
+    def critic_value(self, obs: Tensor, act: Tensor):
+        # the joint obs and joint action of all the agents
+        x = torch.cat((obs, act), 1)
         return self.critic(x).squeeze(1)  # tensor with a given length
 
-    def target_critic_value(self, state_list: List[Tensor], act_list: List[Tensor]):
-        x = torch.cat(state_list + act_list, 1)
+    @inference
+    def target_critic_value(self, obs: Tensor, act: Tensor):
+        # the joint obs and joint action of all the agents
+        x = torch.cat((obs, act), 1)
         return self.target_critic(x).squeeze(1)  # tensor with a given length
 
-    def learn(self, batch_size, gamma):
-        #TODO implement single critic learning
-        obs, act, reward, next_obs, done, next_act = self.sample(batch_size)
-
-        critic_value = self.critic_value(list(obs.values()), list(act.values()))
+    def critic_loss(self, obs, act, reward, next_obs, done, next_act, weights, gamma):
+        """loss of the critic on a batch, and its TD errors"""
+        critic_value = self.critic_value(obs, act)
         # calculate target critic value
-        next_target_critic_value = self.target_critic_value(list(next_obs.values()),
-                                                                list(next_act.values()))
+        next_target_critic_value = self.target_critic_value(next_obs, next_act)
         #FIXME any() might be problematic
-        d = torch.zeros_like(next(iter(done.values())))
+        # Sum over the agents
+        d = done.sum(dim=1)
+        r = reward.sum(dim=1)
 
-        # Sum the tensors
-        for tensor in done.values():
-            d = d + tensor
+        target_value = r + gamma * next_target_critic_value * (1 - d)
 
-        r = torch.zeros_like(next(iter(reward.values())))
+        critic_loss = weighted_mse_loss(critic_value, target_value, weights)
+        return critic_loss, (target_value - critic_value).detach()
 
-        # Sum the tensors
-        for tensor in reward.values():
-            r = r + tensor
+    def actor_loss(self, i, agent, obs, act):
+        """loss of the actor of `agent`, the `i`-th agent, on a batch"""
+        # action of the current agent is calculated using its actor
+        action, logits = agent.action(obs[:, self.buffer.obs_slices[i]], model_out=True)
+        actor_act = self.replace_action(act, i, action)
+        actor_loss = -self.critic_value(obs, actor_act).mean()
+        actor_loss_pse = torch.pow(logits, 2).mean()
+        return actor_loss + 1e-3 * actor_loss_pse
 
-        target_value = r + gamma * next_target_critic_value * (1 - d)
+    def learn(self, batch_size, gamma):
+        obs, act, reward, next_obs, done, next_act, indices, weights = self.sample(batch_size)
 
-        critic_loss = F.mse_loss(critic_value, target_value.detach(), reduction='mean')
+        critic_loss, td_error = self.critic_loss(obs, act, reward, next_obs, done, next_act, weights, gamma)
         self.update_critic(critic_loss)
+        # TD errors are the new priorities of the sampled transitions
+        with self.lock:
+            self.sampler.update(indices, td_error.cpu().numpy())
 
-
-        for agent_id, agent in self.agents.items():
-            obs, act, reward, next_obs, done, next_act = self.sample(batch_size)
+        for i, agent in enumerate(self.agents.values()):
+            if self.independent_samples:
+                obs, act, reward, next_obs, done, next_act, _, _ = self.sample(batch_size)
+            # otherwise the actors learn from the batch of the critic
 
             # update actor
-            # action of the current agent is calculated using its actor
-            action, logits = agent.action(obs[agent_id], model_out=True)
-            act[agent_id] = action
-            actor_loss = -self.critic_value(list(obs.values()), list(act.values())).mean()
-            actor_loss_pse = torch.pow(logits, 2).mean()
-            agent.update_actor(actor_loss + 1e-3 * actor_loss_pse)
+            agent.update_actor(self.actor_loss(i, agent, obs, act))
             # self.logger.info(f'agent{i}: critic loss: {critic_loss.item()}, actor loss: {actor_loss.item()}')
 
     def update_target(self, tau):
-        def soft_update(from_network, to_network):
-            """ copy the parameters of `from_network` to `to_network` with a proportion of tau"""
-            for from_p, to_p in zip(from_network.parameters(), to_network.parameters()):
-                to_p.data.copy_(tau * from_p.data + (1.0 - tau) * to_p.data)
-
-        #TODO implement single update
-        soft_update(self.critic, self.target_critic)
-
-        for agent in self.agents.values():
-            soft_update(agent.actor, agent.target_actor)
-            
+        """move the parameters of the target networks towards those of the networks with a proportion of `tau`,
+        all of them in a single foreach call, which copies them if `tau` is 1"""
+        with torch.no_grad():
+            if tau == 1:
+                torch._foreach_copy_(self.target_params, self.network_params)
+            else:
+                torch._foreach_lerp_(self.target_params, self.network_params, tau)
 
     def save(self, reward):
         """save actor parameters of all agents and training reward to `res_dir`"""
+        self.buffer.flush()
+        if self.telemetry is not None:
+            self.telemetry.flush()
         torch.save(
             {name: agent.actor.state_dict() for name, agent in self.agents.items()},  # actor parameter
             os.path.join(self.res_dir, 'model.pt')
@@ -175,7 +258,8 @@ class MADDPG:
     @classmethod
     def load(cls, dim_info, file):
         """init maddpg using the model saved in `file`"""
-        instance = cls(dim_info, 0, 0, 0, 0, os.path.dirname(file))
+        # the actions selected by a loaded model are not recorded, `res_dir` holds the telemetry of the training
+        instance = cls(dim_info, 0, 0, 0, 0, os.path.dirname(file), action_log_interval=0)
         data = torch.load(file)
         for agent_id, agent in instance.agents.items():
             agent.actor.load_state_dict(data[agent_id])
@@ -1,54 +1,347 @@
+import json
+import os
+
 import numpy as np
 import torch
 
 
 class Buffer:
-    """replay buffer for each agent"""
+    """replay buffer shared by all the agents
+
+    the experience of every agent is stored in one contiguous float32 block of each field,
+    the blocks are ordered as the keys of `dim_info`, i.e. for 3 agents, a row of `obs` is (obs1, obs2, obs3).
+    actions are stored as uint8 indices, one column for each agent, and expanded to one-hot when sampling.
+
+    if `dedup_obs` is True, `next_obs` is not stored as a second copy: in an episode, the next obs of a transition
+    is the obs of the following transition, so it is rebuilt from the successor slot when sampling.
+    only the next obs at episode boundaries are kept, in the small table `boundary_obs`.
+
+    `obs_dtype` decides how `obs` and `next_obs` are stored: 'float32', 'float16', or 'int8' which is affine quantized
+    with a per-feature range tracked online. obs are converted back to float32 only when sampled.
+    """
+
+    obs_dtypes = {'float32': np.float32, 'float16': np.float16, 'int8': np.int8}
 
-    def __init__(self, capacity, obs_dim, act_dim, device):
+    def __init__(self, capacity, dim_info, device, dedup_obs=False, obs_dtype='float32'):
         self.capacity = capacity
+        self.agents = list(dim_info.keys())  # fixed agent order of the blocks
+        self.obs_dims = [obs_dim for obs_dim, _ in dim_info.values()]
+        self.act_dims = [act_dim for _, act_dim in dim_info.values()]
+        # the block of each agent in a row of the joint obs and the joint one-hot action
+        self.obs_slices = self._slices(self.obs_dims)
+        self.act_slices = self._slices(self.act_dims)
+        agent_num = len(self.agents)
 
-        self.obs = np.zeros((capacity, obs_dim))
-        self.action = np.zeros((capacity, act_dim))
-        self.reward = np.zeros(capacity)
-        self.next_obs = np.zeros((capacity, obs_dim))
-        self.done = np.zeros(capacity, dtype=bool)
+        self.obs_dtype = obs_dtype
+        if obs_dtype == 'int8':
+            # a stored value q stands for (q + 128) * obs_scale + obs_low, the range grows when an obs falls out of it
+            self.obs_low = np.zeros(sum(self.obs_dims), dtype=np.float32)
+            self.obs_high = np.zeros(sum(self.obs_dims), dtype=np.float32)
+            self.obs_scale = np.full(sum(self.obs_dims), 1e-6 / 255, dtype=np.float32)
+        self.obs = self._alloc('obs', (capacity, sum(self.obs_dims)), self.obs_dtypes[obs_dtype])
+        assert max(self.act_dims, default=0) <= 256, 'action index is stored as uint8'
+        self.action = self._alloc('action', (capacity, agent_num), np.uint8)
+        # offset of each agent's block in the joint one-hot action
+        self.act_offsets = torch.tensor(np.cumsum([0] + self.act_dims[:-1]), dtype=torch.long)
+        self.reward = self._alloc('reward', (capacity, agent_num), np.float32)
+        self.done = self._alloc('done', (capacity, agent_num), np.float32)
+
+        self.dedup_obs = dedup_obs
+        if dedup_obs:
+            # 0 means the next obs is the obs of the successor slot,
+            # otherwise it is stored in row `boundary_row - 1` of `boundary_obs`
+            self.boundary_row = self._alloc('boundary_row', capacity, np.int64)
+            self.boundary_obs = np.zeros((16, sum(self.obs_dims)), dtype=np.float32)
+            self._free_rows = list(range(len(self.boundary_obs)))
+            self.stride = None  # distance to the successor slot, i.e. number of env copies, known at the first `add`
+        else:
+            self.next_obs = self._alloc('next_obs', (capacity, sum(self.obs_dims)), self.obs_dtypes[obs_dtype])
+
+        # tensors sharing memory with the arrays, batches are gathered from them by `torch.index_select`
+        self._views = {name: torch.from_numpy(getattr(self, name))
+                       for name in ('obs', 'action', 'reward', 'done', 'next_obs') if hasattr(self, name)}
 
         self._index = 0
         self._size = 0
 
         self.device = device
 
+    @staticmethod
+    def _slices(dims):
+        ends = np.cumsum(dims)
+        return [slice(int(end - dim), int(end)) for dim, end in zip(dims, ends)]
+
+    def _alloc(self, name, shape, dtype):
+        """allocate the array of field `name`"""
+        return np.zeros(shape, dtype=dtype)
+
     def add(self, obs, action, reward, next_obs, done):
-        """ add an experience to the memory """
-        self.obs[self._index] = obs
-        self.action[self._index] = action
-        self.reward[self._index] = reward
-        self.next_obs[self._index] = next_obs
-        self.done[self._index] = done
-
-        self._index = (self._index + 1) % self.capacity
-        if self._size < self.capacity:
-            self._size += 1
-
-    def sample(self, indices):
-        # retrieve data, Note that the data stored is ndarray
-        obs = self.obs[indices]
-        action = self.action[indices]
-        reward = self.reward[indices]
-        next_obs = self.next_obs[indices]
-        done = self.done[indices]
-
-        # NOTE that `obs`, `action`, `next_obs` will be passed to network(nn.Module),
-        # so the first dimension should be `batch_size`
-        obs = torch.from_numpy(obs).float().to(self.device)  # torch.Size([batch_size, state_dim])
-        action = torch.from_numpy(action).float().to(self.device)  # torch.Size([batch_size, action_dim])
-        reward = torch.from_numpy(reward).float().to(self.device)  # just a tensor with length: batch_size
+        """ add experience of all the agents to the memory, in the joint layout of a row of the buffer,
+        i.e. obs is of size (num_envs, sum of obs_dim) and reward is of size (num_envs, agent_num),
+        the first dim can be omitted for a single transition.
+        the transitions of the copies are stored in consecutive slots, return the indices where they are stored """
+        # convert to the stored dtype first, so that `next_obs` can be compared with the `obs` of next transition
+        obs = np.atleast_2d(np.asarray(obs, dtype=np.float32))
+        next_obs = np.atleast_2d(np.asarray(next_obs, dtype=np.float32))
+        num = len(obs)
+        indices = (self._index + np.arange(num)) % self.capacity
+
+        if self.obs_dtype == 'int8':
+            self._update_range(np.concatenate((obs, next_obs)))
+        if self.dedup_obs:
+            self._add_dedup(indices, obs, next_obs)
+        else:
+            self.next_obs[indices] = self._encode(next_obs)
+        self.obs[indices] = self._encode(obs)
+        self.action[indices] = np.reshape(action, (num, -1))
+        self.reward[indices] = np.reshape(reward, (num, -1))
+        self.done[indices] = np.reshape(done, (num, -1))
+
+        self._index = (self._index + num) % self.capacity
+        self._size = min(self._size + num, self.capacity)
+        return indices
+
+    def _encode(self, obs):
+        """convert float32 obs to the stored dtype"""
+        if self.obs_dtype != 'int8':
+            return obs  # float16 is converted when assigned
+        return np.clip(np.rint((obs - self.obs_low) / self.obs_scale) - 128, -128, 127)
+
+    def _decode(self, obs):
+        """convert stored obs back to float32"""
+        if self.obs_dtype == 'float32':
+            return obs
+        if self.obs_dtype == 'float16':
+            return obs.astype(np.float32)
+        return (obs.astype(np.float32) + 128) * self.obs_scale + self.obs_low
+
+    def _update_range(self, obs):
+        """make sure the quantization range of int8 covers `obs`, and requantize the stored obs if it grows"""
+        low = np.minimum(self.obs_low, obs.min(axis=0))
+        high = np.maximum(self.obs_high, obs.max(axis=0))
+        grow_low, grow_high = low < self.obs_low, high > self.obs_high
+        if not (grow_low.any() or grow_high.any()):
+            return
+
+        # leave some headroom on the side that grows, so that the range rarely grows again
+        margin = 0.2 * (high - low)
+        low = np.where(grow_low, low - margin, low)
+        high = np.where(grow_high, high + margin, high)
+
+        stored = [self.obs] if self.dedup_obs else [self.obs, self.next_obs]
+        stored = [(arr, self._decode(arr[:self._size])) for arr in stored]
+        self.obs_low, self.obs_high = low.astype(np.float32), high.astype(np.float32)
+        self.obs_scale = np.maximum(self.obs_high - self.obs_low, 1e-6) / 255
+        for arr, obs in stored:
+            arr[:self._size] = self._encode(obs)
+
+    def _add_dedup(self, indices, obs, next_obs):
+        """keep `next_obs` in the boundary table, until it turns out to be the obs of the next transition"""
+        # the experience of each env copy is a stream with a stride of the number of copies
+        if self.stride is None:
+            self.stride = len(indices)
+        if len(indices) != self.stride:
+            raise ValueError(f'experience of {self.stride} env copies is required with dedup_obs, got {len(indices)}')
+
+        # the slots are overwritten, release their boundary rows
+        rows = self.boundary_row[indices]
+        self._free_rows.extend(rows[rows > 0] - 1)
+        self.boundary_row[indices] = 0
+
+        # the next obs of the previous transitions are kept in the table until now,
+        # release the rows of those equal to the obs of the new transitions, i.e. not at an episode boundary
+        if self._size >= self.stride:
+            prev = (indices - self.stride) % self.capacity
+            rows = self.boundary_row[prev]
+            continued = (rows > 0) & np.all(self.boundary_obs[rows - 1] == obs, axis=1)
+            self._free_rows.extend(rows[continued] - 1)
+            self.boundary_row[prev[continued]] = 0
+
+        while len(self._free_rows) < len(indices):  # double the table
+            size = len(self.boundary_obs)
+            self.boundary_obs = np.concatenate((self.boundary_obs, np.zeros_like(self.boundary_obs)))
+            self._free_rows.extend(range(size, 2 * size))
+        rows = np.array(self._free_rows[-len(indices):])
+        del self._free_rows[-len(indices):]
+        self.boundary_obs[rows] = next_obs
+        self.boundary_row[indices] = rows + 1
+
+    def alloc_batch(self, batch_size, pin_memory=False):
+        """allocate the tensors that a batch of `batch_size` is gathered into, see `sample`"""
+        def empty(dim, dtype=torch.float32):
+            return torch.empty((batch_size, dim), dtype=dtype, pin_memory=pin_memory)
+
+        obs_dim, act_dim, agent_num = sum(self.obs_dims), sum(self.act_dims), len(self.agents)
+        batch = {'obs': empty(obs_dim), 'action': empty(act_dim), 'reward': empty(agent_num),
+                 'next_obs': empty(obs_dim), 'done': empty(agent_num), 'action_index': empty(agent_num, torch.uint8)}
+        if self.obs_dtype != 'float32':  # obs in the stored dtype before decoding
+            obs_dtype = self._views['obs'].dtype
+            batch['obs_raw'], batch['next_obs_raw'] = empty(obs_dim, obs_dtype), empty(obs_dim, obs_dtype)
+        return batch
+
+    def _gather_obs(self, name, index, out, raw):
+        """gather rows of the stored obs field `name` into float32 tensor `out`,
+        through `raw` if the stored dtype is not float32"""
+        if self.obs_dtype == 'float32':
+            torch.index_select(self._views[name], 0, index, out=out)
+            return
+        torch.index_select(self._views[name], 0, index, out=raw)
+        out.copy_(raw)
+        if self.obs_dtype == 'int8':
+            out.add_(128).mul_(torch.from_numpy(self.obs_scale)).add_(torch.from_numpy(self.obs_low))
+
+    def sample(self, indices, out=None):
+        """gather the transitions at `indices` into the tensors of `out` (allocated by `alloc_batch`), or new tensors"""
+        if out is None:
+            out = self.alloc_batch(len(indices))
+        index = torch.from_numpy(indices)
+        # retrieve data with a single gather for each field, from the tensors sharing memory with the arrays
+        self._gather_obs('obs', index, out['obs'], out.get('obs_raw'))  # torch.Size([batch_size, sum of obs_dim])
+        # expand the action indices of all the agents to the joint one-hot action in one go
+        torch.index_select(self._views['action'], 0, index, out=out['action_index'])
+        action = out['action'].zero_()  # torch.Size([batch_size, sum of act_dim])
+        action.scatter_(1, out['action_index'].long() + self.act_offsets, 1.0)
+        torch.index_select(self._views['reward'], 0, index, out=out['reward'])  # torch.Size([batch_size, agent_num])
         # reward = (reward - reward.mean()) / (reward.std() + 1e-7)
-        next_obs = torch.from_numpy(next_obs).float().to(self.device)  # Size([batch_size, state_dim])
-        done = torch.from_numpy(done).float().to(self.device)  # just a tensor with length: batch_size
+        if self.dedup_obs:
+            # the next obs is the obs of the successor slot, except for the transitions at episode boundaries
+            self._gather_obs('obs', (index + self.stride) % self.capacity, out['next_obs'], out.get('next_obs_raw'))
+            rows = self.boundary_row[indices]
+            boundary = np.flatnonzero(rows)
+            if len(boundary):
+                out['next_obs'][boundary] = torch.from_numpy(self.boundary_obs[rows[boundary] - 1])
+        else:
+            self._gather_obs('next_obs', index, out['next_obs'], out.get('next_obs_raw'))
+        torch.index_select(self._views['done'], 0, index, out=out['done'])  # torch.Size([batch_size, agent_num])
+
+        non_blocking = out['obs'].is_pinned()
+        return tuple(out[name].to(self.device, non_blocking=non_blocking)
+                     for name in ('obs', 'action', 'reward', 'next_obs', 'done'))
 
-        return obs, action, reward, next_obs, done
+    def flush(self):
+        """make sure the stored experience is persistent, nothing to do for a buffer in memory"""
+        pass
 
     def __len__(self):
         return self._size
+
+
+class MemmapBuffer(Buffer):
+    """replay buffer with all the arrays stored in `np.memmap` files under `path`
+
+    the arrays are flushed every `flush_interval` experiences, together with a header recording `_index` and `_size`.
+    with `dedup_obs`, the boundary table and `boundary_row` are kept in memory and saved as a whole when flushing,
+    so that they agree with each other and with the header, whatever the adds after the last flush.
+    if `path` already holds a buffer (e.g. from a crashed run), it is opened again with the experience in it.
+    with `readonly`, the buffer in `path` is only read, e.g. to sample it after training: the files are mapped
+    copy-on-write, so nothing is written back to them, and `flush` is refused.
+    """
+
+    header_file = 'header.json'
+    boundary_file = 'boundary_obs.npy'  # the boundary table is small, it is saved as a whole when flushing
+    boundary_row_file = 'boundary_row.npy'
+
+    def __init__(self, capacity, dim_info, device, path, dedup_obs=False, obs_dtype='float32', flush_interval=10000,
+                 readonly=False):
+        self.path = path
+        self.flush_interval = flush_interval
+        self.readonly = readonly
+        if not readonly:
+            os.makedirs(path, exist_ok=True)
+        self._memmaps = []  # all the arrays opened by `_alloc`
+
+        header = self._read_header()
+        if readonly and header is None:
+            raise ValueError(f'no buffer in {path} to read')
+        self._resume = header is not None
+        if self._resume:
+            expect = {'capacity': capacity, 'agents': list(dim_info.keys()),
+                      'dims': [[int(dim) for dim in dims] for dims in dim_info.values()], 'dedup_obs': dedup_obs,
+                      'obs_dtype': obs_dtype}
+            for key, val in expect.items():
+                if header[key] != val:
+                    raise ValueError(f'buffer in {path} has {key} {header[key]}, but {val} is required')
+        super().__init__(capacity, dim_info, device, dedup_obs, obs_dtype)
+        if self._resume:
+            self._index, self._size = header['index'], header['size']
+            if obs_dtype == 'int8':
+                self.obs_low = np.array(header['obs_low'], dtype=np.float32)
+                self.obs_high = np.array(header['obs_high'], dtype=np.float32)
+                self.obs_scale = np.maximum(self.obs_high - self.obs_low, 1e-6) / 255
+            if dedup_obs:
+                self.boundary_obs = np.load(os.path.join(path, self.boundary_file))
+                self.boundary_row[:] = np.load(os.path.join(path, self.boundary_row_file))
+                used = set(self.boundary_row[self.boundary_row > 0] - 1)
+                self._free_rows = [row for row in range(len(self.boundary_obs)) if row not in used]
+                self.stride = header['stride']
+
+        self._unflushed = 0  # number of experiences added since last flush
+
+    def _alloc(self, name, shape, dtype):
+        if name == 'boundary_row':  # saved with the boundary table, see `flush`
+            return super()._alloc(name, shape, dtype)
+        file = os.path.join(self.path, f'{name}.dat')
+        # open the existing file when resuming, otherwise create (or overwrite) it
+        mode = 'c' if self.readonly else 'r+' if self._resume else 'w+'
+        arr = np.memmap(file, dtype=dtype, mode=mode, shape=shape)
+        self._memmaps.append(arr)
+        return arr
+
+    def _read_header(self):
+        file = os.path.join(self.path, self.header_file)
+        if not os.path.exists(file):
+            return None
+        with open(file) as f:
+            return json.load(f)
+
+    def _update_range(self, obs):
+        """the stored obs are requantized in the files when the int8 range grows,
+        flush them with the new range right away, so that the header always decodes the data on disk"""
+        obs_low, obs_high = self.obs_low, self.obs_high
+        super()._update_range(obs)
+        if self.obs_low is not obs_low or self.obs_high is not obs_high:
+            self.flush()
+
+    def add(self, obs, action, reward, next_obs, done):
+        indices = super().add(obs, action, reward, next_obs, done)
+        self._unflushed += len(indices)
+        if self._unflushed >= self.flush_interval:
+            self.flush()
+        return indices
+
+    def _save(self, name, arr):
+        """save `arr` to the file `name` under `path` through a temporary file, as the header"""
+        file = os.path.join(self.path, name)
+        with open(file + '.tmp', 'wb') as f:
+            np.save(f, arr)
+        os.replace(file + '.tmp', file)
+
+    def flush(self):
+        """write the arrays to disk first, then the header, so the header never covers experience not on disk"""
+        if self.readonly:
+            raise ValueError(f'buffer in {self.path} is opened read-only')
+        for arr in self._memmaps:
+            arr.flush()
+        if self.dedup_obs:
+            self._save(self.boundary_file, self.boundary_obs)
+            self._save(self.boundary_row_file, self.boundary_row)
+        header = {
+            'capacity': self.capacity,
+            'agents': self.agents,
+            'dims': [[int(obs_dim), int(act_dim)] for obs_dim, act_dim in zip(self.obs_dims, self.act_dims)],
+            'index': self._index,
+            'size': self._size,
+            'dedup_obs': self.dedup_obs,
+            'obs_dtype': self.obs_dtype,
+        }
+        if self.dedup_obs:
+            header['stride'] = self.stride
+        if self.obs_dtype == 'int8':
+            header['obs_low'] = self.obs_low.tolist()
+            header['obs_high'] = self.obs_high.tolist()
+        # write to a temporary file and rename it, a crash never leaves a broken header
+        file = os.path.join(self.path, self.header_file)
+        with open(file + '.tmp', 'w') as f:
+            json.dump(header, f)
+        os.replace(file + '.tmp', file)
+        self._unflushed = 0
@@ -0,0 +1,44 @@
+import functools
+import logging
+
+import torch
+
+
+def _is_compiling():
+    return hasattr(torch, 'compiler') and torch.compiler.is_compiling()
+
+
+def inference(fn):
+    """run `fn` in `torch.inference_mode`, for the computation outside the autograd graph, e.g. the target networks,
+    its output can be used in the loss but not be modified in place.
+    when traced by `torch.compile` (see `Compiled`), which fails on views of normal tensors in inference mode,
+    `fn` runs under `torch.no_grad` instead, a compiled graph keeps no autograd state for it either"""
+    @functools.wraps(fn)
+    def wrapper(*args, **kwargs):
+        with torch.no_grad() if _is_compiling() else torch.inference_mode():
+            return fn(*args, **kwargs)
+    return wrapper
+
+
+class Compiled:
+    """`fn` compiled into a graph with `torch.compile`, falls back to `fn` itself (eager mode) for good
+    when compilation is unavailable, e.g. an old torch or no C++ compiler for the CPU backend
+
+    the compilation happens at the first call (and whenever the input changes, e.g. prioritized weights),
+    so an error in it only shows up then, the call is then run again in eager mode.
+    """
+
+    def __init__(self, fn):
+        self.fn = fn
+        self.compiled_fn = torch.compile(fn) if hasattr(torch, 'compile') else None
+        if self.compiled_fn is None:
+            logging.warning(f'torch.compile is unavailable, {fn.__name__} runs in eager mode')
+
+    def __call__(self, *args, **kwargs):
+        if self.compiled_fn is not None:
+            try:
+                return self.compiled_fn(*args, **kwargs)
+            except Exception as e:  # failed to compile, the inputs are untouched until the graph runs
+                logging.warning(f'failed to compile {self.fn.__name__}, run it in eager mode: {e!r}')
+                self.compiled_fn = None
+        return self.fn(*args, **kwargs)
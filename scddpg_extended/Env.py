@@ -0,0 +1,26 @@
+from pettingzoo.mpe import simple_adversary_v3, simple_spread_v3, simple_tag_v3, simple_v3, simple_world_comm_v3
+
+
+def get_env(env_name, ep_len=25, mode= None):
+    """create environment and get observation and action dimension of each agent in this environment"""
+    new_env = None
+    if env_name == 'simple_adversary_v3':
+        new_env = simple_adversary_v3.parallel_env(max_cycles=ep_len, render_mode= mode)
+    if env_name == 'simple_spread_v3':
+        new_env = simple_spread_v3.parallel_env(max_cycles=ep_len, render_mode= mode)
+    if env_name == 'simple_tag_v3':
+        new_env = simple_tag_v3.parallel_env(max_cycles=ep_len, render_mode= mode)
+    if env_name == "simple_v3":
+        new_env = simple_v3.parallel_env(max_cycles=ep_len, render_mode= mode)
+    if env_name == "simple_world_comm_v3":
+        new_env = simple_world_comm_v3.parallel_env(max_cycles=ep_len, render_mode= mode)
+
+
+    new_env.reset()
+    _dim_info = {}
+    for agent_id in new_env.agents:
+        _dim_info[agent_id] = []  # [obs_dim, act_dim]
+        _dim_info[agent_id].append(new_env.observation_space(agent_id).shape[0])
+        _dim_info[agent_id].append(new_env.action_space(agent_id).n)
+
+    return new_env, _dim_info
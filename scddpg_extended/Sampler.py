@@ -0,0 +1,165 @@
+import numpy as np
+
+
+class Sampler:
+    """choose which transitions of the replay buffer are used in a batch"""
+
+    def __init__(self, capacity):
+        self.capacity = capacity  # capacity of the replay buffer
+
+    def sample(self, total_num, batch_size):
+        """return `batch_size` indices in range [0, total_num)"""
+        raise NotImplementedError
+
+    def weights(self, total_num, indices):
+        """importance-sampling weights of the sampled `indices`, None means all the transitions weigh the same"""
+        return None
+
+    def add(self, indices):
+        """new transitions are stored at `indices` of the buffer"""
+        pass
+
+    def update(self, indices, td_errors):
+        """TD errors of the transitions at `indices` are calculated during learning"""
+        pass
+
+
+class UniformSampler(Sampler):
+    """uniform sampling with replacement, a transition might appear more than once in a batch"""
+
+    def sample(self, total_num, batch_size):
+        return np.random.randint(total_num, size=batch_size)
+
+
+class UniqueSampler(Sampler):
+    """uniform sampling without replacement, the cost only depends on `batch_size`
+
+    `np.random.choice(total_num, batch_size, replace=False)` permutes all the `total_num` indices,
+    here we draw indices with replacement and only redraw the duplicated ones (rejection sampling).
+    when `batch_size` is no more than half of `total_num`, at most 2 * `batch_size` indices are drawn in expectation.
+    """
+
+    def sample(self, total_num, batch_size):
+        if batch_size > total_num:
+            raise ValueError(f'can not sample {batch_size} transitions out of {total_num} without replacement')
+        if 2 * batch_size > total_num:
+            # the population is small, a permutation is no more than O(batch_size)
+            return np.random.permutation(total_num)[:batch_size]
+
+        indices = self._unique(np.random.randint(total_num, size=batch_size))
+        while len(indices) < batch_size:
+            extra = np.random.randint(total_num, size=batch_size - len(indices))
+            indices = self._unique(np.concatenate((indices, extra)))
+        # the indices are sorted now, shuffle them to keep the order of the batch random
+        np.random.shuffle(indices)
+        return indices
+
+    @staticmethod
+    def _unique(indices):
+        """sorted unique indices, cheaper than `np.unique` for small arrays"""
+        indices.sort()
+        keep = np.empty(len(indices), dtype=bool)
+        keep[0] = True
+        np.not_equal(indices[1:], indices[:-1], out=keep[1:])
+        return indices[keep]
+
+
+class StratifiedSampler(Sampler):
+    """split [0, total_num) into `batch_size` equal segments and sample one index from each of them,
+    the batch covers the whole buffer evenly and has no duplicated index"""
+
+    def sample(self, total_num, batch_size):
+        if batch_size > total_num:
+            raise ValueError(f'can not sample {batch_size} transitions out of {total_num} without replacement')
+        # integer boundaries of the segments, every segment contains at least one index
+        bounds = np.arange(batch_size + 1) * total_num // batch_size
+        length = bounds[1:] - bounds[:-1]
+        return bounds[:-1] + (np.random.random(batch_size) * length).astype(np.int64)
+
+
+class SumTree:
+    """array-backed binary tree, every node holds the sum of its two children and the leaves hold the priorities
+
+    `tree[1]` is the root, the children of node i are 2i and 2i+1, the leaf of index j is `tree[leaf_num + j]`.
+    both update and lookup work on a batch of indices at once, walking the tree one level at a time.
+    """
+
+    def __init__(self, capacity):
+        self.leaf_num = 1 << max(capacity - 1, 0).bit_length()  # power of 2 that is no less than capacity
+        self.depth = self.leaf_num.bit_length() - 1
+        self.tree = np.zeros(2 * self.leaf_num)
+
+    def total(self):
+        return self.tree[1]
+
+    def get(self, indices):
+        return self.tree[indices + self.leaf_num]
+
+    def update(self, indices, priorities):
+        nodes = indices + self.leaf_num
+        self.tree[nodes] = priorities
+        # recompute the sums on the path to the root, a parent shared by several nodes is just written more than once
+        for _ in range(self.depth):
+            nodes = nodes // 2
+            self.tree[nodes] = self.tree[2 * nodes] + self.tree[2 * nodes + 1]
+
+    def find(self, values):
+        """indices of the leaves where the prefix sum of the priorities reaches `values`"""
+        nodes = np.ones(len(values), dtype=np.int64)
+        values = values.copy()
+        for _ in range(self.depth):
+            left = 2 * nodes
+            left_sum = self.tree[left]
+            go_right = values >= left_sum
+            values -= left_sum * go_right
+            nodes = left + go_right
+        return nodes - self.leaf_num
+
+
+class PrioritizedSampler(Sampler):
+    """prioritized experience replay, a transition is sampled with probability proportional to priority^alpha,
+    where the priority is its latest absolute TD error. new transitions get the max priority so far.
+    the bias is corrected by importance-sampling weights (N * P(i))^-beta, normalized by the max weight of the batch.
+    """
+
+    def __init__(self, capacity, alpha=0.6, beta=0.4, eps=1e-6):
+        super().__init__(capacity)
+        self.alpha = alpha
+        self.beta = beta
+        self.eps = eps  # make sure every transition has chance to be sampled
+        self.tree = SumTree(capacity)
+        self.max_priority = 1.0  # max priority^alpha so far
+
+    def sample(self, total_num, batch_size):
+        # split the total priority into `batch_size` equal segments and sample one value from each of them
+        segment = self.tree.total() / batch_size
+        values = (np.arange(batch_size) + np.random.random(batch_size)) * segment
+        # guard against float rounding landing on an empty leaf
+        return np.minimum(self.tree.find(values), total_num - 1)
+
+    def weights(self, total_num, indices):
+        prob = self.tree.get(indices) / self.tree.total()
+        weights = (total_num * prob) ** -self.beta
+        return (weights / weights.max()).astype(np.float32)
+
+    def add(self, indices):
+        indices = np.atleast_1d(indices)
+        self.tree.update(indices, np.full(len(indices), self.max_priority))
+
+    def update(self, indices, td_errors):
+        priorities = (np.abs(td_errors) + self.eps) ** self.alpha
+        self.max_priority = max(self.max_priority, priorities.max())
+        self.tree.update(indices, priorities)
+
+
+SAMPLERS = {
+    'uniform': UniformSampler,
+    'unique': UniqueSampler,
+    'stratified': StratifiedSampler,
+    'prioritized': PrioritizedSampler,
+}
+
+
+def get_sampler(name, capacity, **kwargs):
+    """create sampler by its name in `SAMPLERS`"""
+    return SAMPLERS[name](capacity, **kwargs)
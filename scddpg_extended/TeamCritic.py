@@ -0,0 +1,45 @@
+from copy import deepcopy
+
+import torch
+
+from Agent import MLPNetwork
+from Ensemble import CriticEnsemble
+
+
+class TeamCritic:
+    """a critic of each team of agents, the critics of all the teams are evaluated and trained together
+
+    `teams` is a partition of the agents, the index of the agents of each team in the joint layout,
+    the critic of a team takes the joint obs and action of all the agents, and learns the return of the team,
+    i.e. of the sum of the reward of its agents.
+    the critics are packed into stacked tensors and evaluated in one batched matmul, see `CriticEnsemble`.
+    """
+
+    def __init__(self, teams, in_dim, lr, max_norm=0.5):
+        self.critics = [MLPNetwork(in_dim, 1) for _ in teams]
+        self.target_critics = [deepcopy(critic) for critic in self.critics]
+        self.ensemble = CriticEnsemble(self.critics, self.target_critics, lr, max_norm)
+        # mask of the agents of each team, the team reward is `reward @ mask` for reward of size (batch_size, agent_num)
+        self.mask = torch.zeros(sum(len(index) for index in teams), len(teams))
+        for t, index in enumerate(teams):
+            self.mask[index, t] = 1
+
+    def team_sum(self, x):
+        """the sum of `x` (e.g. reward) of the agents of each team, of size (team_num, batch_size)"""
+        return (x @ self.mask).T
+
+    def value(self, obs, act, team=None):
+        """value of the critic of each team given the joint obs and action, of size (team_num, batch_size),
+        or only of the critic of `team`, of size (batch_size)"""
+        x = torch.cat((obs, act), 1)
+        value = self.ensemble.value(x.expand(len(self.critics), -1, -1))
+        # through the stacked parameters, the parameters of `critics` are only views of them and get no gradient
+        return value if team is None else value[team]
+
+    def target_value(self, obs, act):
+        x = torch.cat((obs, act), 1)
+        return self.ensemble.target_value(x.expand(len(self.critics), -1, -1))
+
+    def update(self, loss):
+        """`loss` is the sum of the loss of the critic of each team"""
+        self.ensemble.update(loss)
@@ -0,0 +1,198 @@
+import multiprocessing as mp
+from multiprocessing import shared_memory
+
+import numpy as np
+
+
+def join_obs(obs, agents):
+    """convert the obs of pettingzoo (dict with agent name as its key) to the joint obs, concatenated in `agents` order"""
+    return np.concatenate([obs[agent_id] for agent_id in agents], axis=-1)
+
+
+def join(experience, agents):
+    """convert the reward, done or action of pettingzoo to an array of the agents in `agents` order"""
+    return np.stack([experience[agent_id] for agent_id in agents], axis=-1)
+
+
+def split(action, agents):
+    """convert the joint action (of size (agent_num) or (num_envs, agent_num)) to the dict of pettingzoo"""
+    # NOTE that iterating yields scalars for a single env, not 0-d arrays which pettingzoo would modify in place
+    return dict(zip(agents, np.asarray(action).T))
+
+
+class VectorEnv:
+    """copies of a parallel env from pettingzoo, stepped in lockstep
+
+    the experience is in the joint layout of the agents (ordered as `agents`), stacked over the copies:
+    obs is of size (num_envs, sum of obs_dim), action, reward and done are of size (num_envs, agent_num).
+    the dicts of pettingzoo are converted only here, see `join_obs`, `join` and `split`.
+    a copy is reset automatically when its episode finishes, see `step`.
+    """
+
+    def __init__(self, envs):
+        self.envs = envs
+        self.num_envs = len(envs)
+        self.agents = list(envs[0].possible_agents)
+        self.obs = None  # obs of the current step of all the copies
+
+    def observation_space(self, agent_id):
+        return self.envs[0].observation_space(agent_id)
+
+    def action_space(self, agent_id):
+        return self.envs[0].action_space(agent_id)
+
+    def _stack(self, experience, convert=join):
+        """stack the experience (list of dict) of all the copies"""
+        return np.stack([convert(e, self.agents) for e in experience])
+
+    def reset(self):
+        self.obs = self._stack([env.reset()[0] for env in self.envs], join_obs)
+        return self.obs
+
+    def sample_action(self):
+        """random actions of all the copies"""
+        return np.array([[env.action_space(agent_id).sample() for agent_id in self.agents] for env in self.envs])
+
+    def step(self, action):
+        """step all the copies with `action` (of size (num_envs, agent_num)),
+        return next_obs, reward, done, truncated and `finished` (bool array of size num_envs)
+
+        for a copy that finishes its episode, `next_obs` is the last obs of the episode,
+        and the copy is reset, so `self.obs` holds the first obs of its next episode.
+        """
+        experience = []
+        finished = np.zeros(self.num_envs, dtype=bool)
+        reset_obs = {}
+        for i, env in enumerate(self.envs):
+            experience.append(env.step(split(action[i], self.agents)))
+            if not env.agents:  # episode finishes
+                finished[i] = True
+                reset_obs[i] = env.reset()[0]
+
+        # info is not used
+        obs, reward, done, truncated = list(zip(*experience))[:4]
+        next_obs = self._stack(obs, join_obs)
+        reward, done, truncated = self._stack(reward), self._stack(done), self._stack(truncated)
+        self.obs = next_obs
+        if reset_obs:  # replace the obs of the finished copies, keep `next_obs` unchanged
+            self.obs = next_obs.copy()
+            for i, o in reset_obs.items():
+                self.obs[i] = join_obs(o, self.agents)
+        return next_obs, reward, done, truncated, finished
+
+    def close(self):
+        for env in self.envs:
+            env.close()
+
+
+def _shared_arrays(specs, shms=None):
+    """numpy arrays over shared memory, `specs` is a dict of name: (shape, dtype),
+    the shared memory blocks are created, or attached if `shms` is given"""
+    if shms is None:
+        shms = {name: shared_memory.SharedMemory(create=True, size=max(1, int(np.prod(shape)) * np.dtype(dtype).itemsize))
+                for name, (shape, dtype) in specs.items()}
+    arrays = {name: np.ndarray(shape, dtype=dtype, buffer=shms[name].buf) for name, (shape, dtype) in specs.items()}
+    return shms, arrays
+
+
+def _worker(index, env_fn, agents, specs, shms, pipe):
+    """step the env copy `index`, and write the experience to row `index` of the shared arrays,
+    the pipe only carries the commands and an acknowledgement (or the error raised)"""
+    _, arrays = _shared_arrays(specs, shms)
+    env, _ = env_fn()
+
+    while True:
+        command, slot = pipe.recv()
+        try:
+            if command == 'reset':
+                arrays[f'obs{slot}'][index] = join_obs(env.reset()[0], agents)
+            elif command == 'step':
+                next_obs, reward, done, truncated, info = env.step(split(arrays['action'][index], agents))
+                arrays['next_obs'][index] = join_obs(next_obs, agents)
+                for name, experience in (('reward', reward), ('done', done), ('truncated', truncated)):
+                    arrays[name][index] = join(experience, agents)
+                arrays['finished'][index] = not env.agents
+                if env.agents:
+                    arrays[f'obs{slot}'][index] = arrays['next_obs'][index]
+                else:  # episode finishes
+                    arrays[f'obs{slot}'][index] = join_obs(env.reset()[0], agents)
+            elif command == 'close':
+                env.close()
+                pipe.send(None)
+                return
+            pipe.send(None)
+        except Exception as e:  # hand the error over to the main process instead of leaving it waiting forever
+            pipe.send(e)
+
+
+class SubprocVectorEnv(VectorEnv):
+    """copies of a parallel env stepped in worker processes, one process for each copy
+
+    the interface is the same as `VectorEnv`, but the experience is exchanged through shared memory:
+    the returned arrays are the shared arrays,
+    `next_obs`, reward, done and truncated are valid until the next call of `step`,
+    the obs (`self.obs`) until the call after that, as it is double-buffered.
+    `env_fn` creates an env as `get_env` in main.py, i.e. returns the env and its dim_info.
+    """
+
+    def __init__(self, env_fn, num_envs, dim_info):
+        self.num_envs = num_envs
+        self.agents = list(dim_info)
+        self.dim_info = dim_info
+        agent_num = len(self.agents)
+        obs_shape = (num_envs, sum(obs_dim for obs_dim, _ in dim_info.values()))
+        self.specs = {'obs0': (obs_shape, np.float32), 'obs1': (obs_shape, np.float32),
+                      'next_obs': (obs_shape, np.float32), 'action': ((num_envs, agent_num), np.int64),
+                      'reward': ((num_envs, agent_num), np.float32), 'done': ((num_envs, agent_num), bool),
+                      'truncated': ((num_envs, agent_num), bool), 'finished': ((num_envs,), bool)}
+        self.shms, self.arrays = _shared_arrays(self.specs)
+        self.slot = 0  # the obs array holding `self.obs`
+
+        self.pipes = []
+        self.processes = []
+        for index in range(num_envs):
+            pipe, worker_pipe = mp.Pipe()
+            process = mp.Process(target=_worker, args=(index, env_fn, self.agents, self.specs, self.shms, worker_pipe),
+                                 daemon=True)
+            process.start()
+            worker_pipe.close()
+            self.pipes.append(pipe)
+            self.processes.append(process)
+        self.obs = None
+
+    def _call(self, command, slot):
+        for pipe in self.pipes:
+            pipe.send((command, slot))
+        for pipe in self.pipes:  # wait for all the copies
+            error = pipe.recv()
+            if error is not None:
+                raise error
+
+    def reset(self):
+        self._call('reset', self.slot)
+        self.obs = self.arrays[f'obs{self.slot}']
+        return self.obs
+
+    def sample_action(self):
+        """random actions of all the copies"""
+        return np.random.randint([act_dim for _, act_dim in self.dim_info.values()],
+                                 size=(self.num_envs, len(self.agents)))
+
+    def step(self, action):
+        self.arrays['action'][:] = action
+        # write the obs of the next step to the other obs array, keep `self.obs` for the caller
+        self.slot = 1 - self.slot
+        self._call('step', self.slot)
+        self.obs = self.arrays[f'obs{self.slot}']
+        return (self.arrays['next_obs'], self.arrays['reward'], self.arrays['done'], self.arrays['truncated'],
+                self.arrays['finished'])
+
+    def close(self):
+        for pipe in self.pipes:
+            pipe.send(('close', None))
+        for pipe, process in zip(self.pipes, self.processes):
+            pipe.recv()
+            process.join()
+        # the returned arrays might still be in use, the memory is released when they are gone
+        for shm in self.shms.values():
+            shm.unlink()
@@ -5,8 +5,9 @@ import numpy as np
 import matplotlib.pyplot as plt
 from PIL import Image
 
-from MADDPG import MADDPG
-from main import get_env
+from Env import get_env
+from NumpyPolicy import NumpyPolicy
+from VectorEnv import join_obs, split
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser()
@@ -15,6 +16,10 @@ if __name__ == '__main__':
     parser.add_argument('folder', type=str, help='name of the folder where model is saved')
     parser.add_argument('--episode-num', type=int, default=10, help='total episode num during evaluation')
     parser.add_argument('--episode-length', type=int, default=50, help='steps per episode')
+    parser.add_argument('--numpy', action='store_true',
+                        help='select the actions with the actors exported by NumpyPolicy.py, without torch')
+    parser.add_argument('--int8', action='store_true',
+                        help='with --numpy, use the actors exported with int8 weights by NumpyPolicy.py --int8')
 
     args = parser.parse_args()
 
@@ -26,7 +31,12 @@ if __name__ == '__main__':
     gif_num = len([file for file in os.listdir(gif_dir)])  # current number of gif
 
     env, dim_info = get_env(args.env_name, args.episode_length, 'rgb_array')
-    maddpg = MADDPG.load(dim_info, os.path.join(model_dir, 'model.pt'))
+    if args.numpy:
+        policy = NumpyPolicy.load(os.path.join(model_dir, 'model_int8.npz' if args.int8 else 'model.npz'))
+        select_action = lambda obs: policy.action(obs, explore=True)  # sampled as `MADDPG.select_action`
+    else:
+        from MADDPG import MADDPG  # torch is only imported when needed
+        select_action = MADDPG.load(dim_info, os.path.join(model_dir, 'model.pt')).select_action
 
     agent_num = env.num_agents
     # reward of each episode of each agent
@@ -36,7 +46,8 @@ if __name__ == '__main__':
         agent_reward = {agent: 0 for agent in env.agents}  # agent reward of the current episode
         frame_list = []  # used to save gif
         while env.agents :  # interact with the env for an episode
-            actions = maddpg.select_action(states)
+            # the joint layout of the agents is only used inside, convert at the pettingzoo boundary
+            actions = split(select_action(join_obs(states, dim_info)), dim_info)
             next_states, rewards, dones, truncated,infos = env.step(actions)
             frame= env.render()
             frame_list.append(Image.fromarray(frame))